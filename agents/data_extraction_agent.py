@@ -1,111 +1,273 @@
 from __future__ import annotations
 
-import os
-from dotenv import load_dotenv
-import json
+import asyncio
+import re
+from functools import lru_cache
 
-load_dotenv()
-
-from langchain_openai import ChatOpenAI
+import pyarrow as pa
+import pyarrow.compute as pc
 from langchain_core.messages import AIMessage
 
 from state import RetailAgenticState
 from models import DataExtractionOutput
+from cache import LRUCache, hash_key
+from config import OPENAI_API_KEY
+from llm import FAST_MODEL, cascade, structured_llm
 
 
+# Static prefix first, per-call spec and feedback last (see llm.py)
 SYSTEM_PROMPT = """\
-You are a SQL generation agent working with DuckDB.
-
-You will receive:
-- A structured query specification (intent, columns, aggregations, filters, sort, limit)
-- The table name and schema metadata
-
-Your job: write a single, complete, executable DuckDB SQL query that fulfils the spec.
+You are a DuckDB SQL generator. Input: table name + metadata, then a query spec
+(intent, columns, aggregations, filters, sort, limit). Output one complete,
+executable DuckDB query that fulfils the spec.
 
 Rules:
-- Always double-quote column names (they may contain spaces or hyphens): "Order ID", "ship-city"
-- Use the exact table name given — do not quote the table name itself
-- For string filtering use ILIKE to handle mixed case in the data
-- For counting orders use COUNT(DISTINCT "Order ID"), not COUNT(*)
-- SUM() and AVG() ignore NULLs automatically — safe on nullable columns
-- For date filtering use DuckDB DATE literals: DATE '2022-04-01'
-- For boolean columns filter with = true or = false (no quotes)
-- Do not add LIMIT unless the spec explicitly sets one
-- Return only the SQL — no markdown, no explanation in the sql field
+- double-quote every column ("Order ID", "ship-city"); never quote the table name
+- strings: ILIKE; booleans: = true / = false (unquoted); dates: DATE '2022-04-01'
+- order counts: COUNT(DISTINCT "Order ID"), not COUNT(*)
+- SUM/AVG already skip NULLs
+- LIMIT only if the spec sets one
+- sql field: SQL only, no markdown, no explanation
 """
 
-def data_extraction_agent(state: RetailAgenticState) -> RetailAgenticState:
+# (data version, SQL) -> (pyarrow.Table, total row count). Arrow tables are
+# immutable so a cached result can be shared between questions. Bounded by
+# the tables' Arrow buffer size as well as by entry count.
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_RESULT_CACHE = LRUCache(maxsize=256, maxbytes=RESULT_CACHE_MAX_BYTES,
+                         sizeof=lambda result: result[0].nbytes)
+
+# Results are streamed as Arrow record batches and only the first
+# RESULT_MAX_ROWS rows are kept: the agents only ever read the head of a
+# result, so a runaway "list every order" query is counted, not held.
+RESULT_BATCH_ROWS = 8192
+RESULT_MAX_ROWS = 10_000
+
+# sha256(system prompt, user prompt) -> SQL that passed validation.
+# The user prompt already carries table name, metadata, spec and feedback.
+_EXTRACTION_CACHE = LRUCache(maxsize=512)
+
+# On a retry the first fix is not guaranteed to work either, so several
+# candidates (the strong model plus sampled fast-model drafts) are generated
+# and executed concurrently; the first that runs and returns rows is kept.
+SQL_RETRY_CANDIDATES = 3
+CANDIDATE_TEMPERATURE = 0.7
+
+# Captures the body of a ```sql ... ``` fenced block in a single scan
+_SQL_FENCE_RE = re.compile(r"^\s*```(?:sql)?\s*(.*?)\s*```\s*$", re.DOTALL | re.IGNORECASE)
+
+
+def strip_sql_fences(text: str) -> str:
+    """Remove a markdown code fence the LLM may wrap around the SQL"""
+    m = _SQL_FENCE_RE.match(text)
+    return (m.group(1) if m else text).strip()
+
+
+# Built once per table so every question sends the identical prefix
+@lru_cache(maxsize=32)
+def table_system_prompt(table_name: str, table_metadata: str) -> str:
+    return f"""Table name   : {table_name}
+Table metadata:
+{table_metadata}"""
+
+
+def _fetch_arrow(con, sql: str) -> tuple[pa.Table, int]:
+    reader = con.execute(sql).fetch_record_batch(RESULT_BATCH_ROWS)
+    batches: list[pa.RecordBatch] = []
+    kept = total = 0
+    for batch in reader:
+        total += batch.num_rows
+        if kept < RESULT_MAX_ROWS:
+            batch = batch.slice(0, RESULT_MAX_ROWS - kept)
+            batches.append(batch)
+            kept += batch.num_rows
+    return pa.Table.from_batches(batches, schema=reader.schema), total
+
+
+def _describe_columns(con, table_name: str) -> str:
+    rows = con.execute(f"DESCRIBE {table_name}").fetchall()
+    return ", ".join(f'"{name}" {dtype}' for name, dtype, *_ in rows)
+
+
+def _filter_metadata(table_metadata: str, columns: set[str]) -> str:
+    """Header + metadata rows (type, samples, ranges) of the given columns"""
+    lines = table_metadata.splitlines()
+    header = next((line for line in lines if line.startswith("n\t")), "")
+    rows = [line for line in lines if line.split("\t", 1)[0] in columns]
+    return "\n".join([header, *rows]) if rows else ""
+
+
+async def _run_on_db(state: RetailAgenticState, fn, *args):
+    """Run fn(con, *args) in a worker thread on a pooled cursor (or db_con)"""
+    pool = state.get("db_pool")
+    if pool is None:
+        return await asyncio.to_thread(fn, state["db_con"], *args)
+    return await pool.run(fn, *args)
+
+
+async def _execute(state: RetailAgenticState, sql: str) -> tuple[pa.Table, int]:
+    # Exceuting the sql query on a pooled cursor of the shared DuckDB
+    # database, off the event loop so other graph work is not blocked
+    result_key = hash_key(str(state.get("data_version", 0)), sql.strip())
+    cached = _RESULT_CACHE.get(result_key)
+    if cached is None:
+        cached = await _run_on_db(state, _fetch_arrow, sql)
+        _RESULT_CACHE.set(result_key, cached)
+    return cached
+
+
+def _zero_or_null(col) -> bool:
+    if col.null_count == len(col):
+        return True
+    bounds = pc.min_max(col)
+    return bounds["min"].as_py() == 0 and bounds["max"].as_py() == 0
+
+
+def result_rule_failure(table: pa.Table, resolution) -> str | None:
+    """
+    Rule checks a result must pass before it is worth validating: returns the
+    failure reason, or None when the result passes.
+    """
+    if table.num_rows == 0:
+        return ("Empty result - the filters are too strict or the filter values do not match the data "
+                "(check exact spelling/case of values and date formats).")
+
+    numeric = [c for c in table.columns if pa.types.is_integer(c.type) or pa.types.is_floating(c.type)
+               or pa.types.is_decimal(c.type)]
+    if resolution.aggregations and numeric and all(_zero_or_null(c) for c in numeric):
+        return "All aggregated values are 0 or NULL - wrong measure column or a filter that excludes every row."
+    return None
+
+
+async def _retry_candidates(messages: list[dict], cache_key: str) -> list[DataExtractionOutput]:
+    """SQL_RETRY_CANDIDATES drafts generated concurrently; failed calls are dropped"""
+    drafter = structured_llm(FAST_MODEL, DataExtractionOutput, CANDIDATE_TEMPERATURE, cache_key)
+    results = await asyncio.gather(
+        cascade(DataExtractionOutput, messages, escalate=True, cache_key=cache_key),
+        *(drafter.ainvoke(messages) for _ in range(SQL_RETRY_CANDIDATES - 1)),
+        return_exceptions=True,
+    )
+    candidates = [r for r in results if not isinstance(r, BaseException)]
+    if not candidates:
+        raise results[0]
+    return candidates
+
+
+async def data_extraction_agent(state: RetailAgenticState) -> RetailAgenticState:
     """This agent generates sql query and its explanation using the resolution output"""
 
-    api_key    = os.getenv("OPENAI_API_KEY")
+    api_key    = OPENAI_API_KEY
     resolution = state.get("resolution")
 
     if not api_key:
-        return {**state, "error": "OPENAI_API_KEY not set.",
-                "messages": state["messages"] + [AIMessage(content="DataExtractionAgent: no API key")]}
+        return {"error": "OPENAI_API_KEY not set.",
+                "messages": [AIMessage(content="DataExtractionAgent: no API key")]}
 
     if not resolution:
-        return {**state, "error": "data_extraction_agent: no resolution in state",
-                "messages": state["messages"] + [AIMessage(content="DataExtractionAgent: no resolution")]}
+        return {"error": "data_extraction_agent: no resolution in state",
+                "messages": [AIMessage(content="DataExtractionAgent: no resolution")]}
     
-    llm = ChatOpenAI(
-        model = "gpt-5-mini",
-        api_key=api_key,
-        temperature=0
-    )
-
-    structured_llm = llm.with_structured_output(DataExtractionOutput)
-
 
     feedback = state.get("validation_feedback", "")
-    retry_note = (
-        f"\n\nPREVIOUS SQL ATTEMPT FAILED VALIDATION:\n{feedback}\n"
-        f"Fix the SQL to address this issue."
-        if feedback else ""
-    )
-
-    user_prompt = f"""Table name   : {state['table_name']}
-Table metadata:
-{state['table_metadata']}
+    previous_sql = state.get("sql", "")
+    spec_json = resolution.model_dump_json(indent=2)
+    sql = ""
 
+    try:
+        if feedback and previous_sql and state.get("failure_stage") in ("sql", "execution"):
+            # SQL-level retry: the spec is fine, so send the failed SQL, the error
+            # and the bare column list instead of the full metadata block again.
+            # Filtered columns keep their metadata rows: a wrong filter value
+            # (empty result) can only be fixed against the sample values.
+            columns = await _run_on_db(state, _describe_columns, state["table_name"])
+            filter_rows = _filter_metadata(state["table_metadata"], {f.column for f in resolution.filters})
+            filter_block = f"\nFilter columns (sv = sample values):\n{filter_rows}\n" if filter_rows else ""
+            messages = [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": f"""Table name   : {state['table_name']}
+Columns: {columns}
+{filter_block}
 Query specification:
-{json.dumps(resolution.model_dump(), indent=2)}{retry_note}
+{spec_json}
+
+Previous SQL:
+{previous_sql}
+
+PREVIOUS SQL ATTEMPT FAILED VALIDATION:
+{feedback}
+Fix the SQL to address this issue.
+"""},
+            ]
+        else:
+            retry_note = (
+                f"\n\nPREVIOUS SQL ATTEMPT FAILED VALIDATION:\n{feedback}\n"
+                f"Fix the SQL to address this issue."
+                if feedback else ""
+            )
+            table_prompt = table_system_prompt(state["table_name"], state["table_metadata"])
+            user_prompt = f"""Query specification:
+{spec_json}
 
-Generate the DuckDB SQL query that fulfils this specification exactly.
+Generate the DuckDB SQL query that fulfils this specification exactly.{retry_note}
 """
-    
-    try:
-        response: DataExtractionOutput = structured_llm.invoke([
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt},
-        ])
+            messages = [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "system", "content": table_prompt},
+                {"role": "user", "content": user_prompt},
+            ]
 
-        sql = response.sql.strip().removeprefix("```sql").removeprefix("```").removesuffix("```").strip()
+        cache_key = hash_key(*(m["content"] for m in messages))
+        prompt_cache_key = f"extraction:{state['table_name']}"
+        cached = _EXTRACTION_CACHE.get(cache_key)
+        if cached is not None:
+            sqls = [cached]
+        else:
+            if feedback:
+                candidates = await _retry_candidates(messages, prompt_cache_key)
+            else:
+                candidates = [await cascade(DataExtractionOutput, messages, cache_key=prompt_cache_key)]
+            # identical drafts are only executed once
+            sqls = list(dict.fromkeys(strip_sql_fences(c.sql) for c in candidates))
+        sql = sqls[0]
+        outcomes = await asyncio.gather(*(_execute(state, q) for q in sqls), return_exceptions=True)
 
-        # Exceuting the sql query against the shared DuckDB connection
-        result = state["db_con"].execute(sql)
-        columns = [desc[0] for desc in result.description]
-        rows = [dict(zip(columns, row)) for row in result.fetchall()]
+        # first candidate that ran and passes the validation rule checks,
+        # else the first that ran
+        ran = [i for i, o in enumerate(outcomes) if not isinstance(o, BaseException)]
+        if not ran:
+            raise outcomes[0]
+        best = next((i for i in ran if result_rule_failure(outcomes[i][0], resolution) is None), ran[0])
+        sql = sqls[best]
+        table, row_count = outcomes[best]
 
         return {
-            **state,
             "sql": sql,
-            "rows": rows,
-            "columns": columns,
+            # cached by remember_sql only once validation passes
+            "extraction_cache_key": "" if cached is not None else cache_key,
+            "result": table,
+            "row_count": row_count,
             "error": None,
-            "messages": state["messages"] + [
-                AIMessage(content=f"DataExtractionAgent: SQL generated & executed -> {len(rows)} rows")
+            "messages": [
+                AIMessage(content=f"DataExtractionAgent: SQL generated & executed -> {row_count} rows")
             ],
         }
         
     except Exception as e:
+        # keep the failed SQL so a retry can fix it instead of starting over
         return {
-            **state,
-            "sql":      "",
-            "rows":     [],
-            "columns":  [],
+            "sql":      sql,
+            "extraction_cache_key": "",
+            "result":   None,
+            "row_count": 0,
             "error":    f"data_extraction_agent failed: {e}",
-            "messages": state["messages"] + [
+            "messages": [
                 AIMessage(content=f"DataExtractionAgent: error - {e}")
             ],
-        }
\ No newline at end of file
+        }
+
+
+def remember_sql(state: RetailAgenticState) -> None:
+    """Cache this run's new SQL; called by validation once the result passed"""
+    key = state.get("extraction_cache_key")
+    if key and state.get("sql"):
+        _EXTRACTION_CACHE.set(key, state["sql"])
@@ -1,26 +1,70 @@
 from __future__ import annotations
 
-import os
-from dotenv import load_dotenv
+import asyncio
 
-load_dotenv()
-
-from langchain_openai import ChatOpenAI
+import pyarrow as pa
+import pyarrow.compute as pc
 from langchain_core.messages import AIMessage
 
 from state import RetailAgenticState
+from cache import LRUCache, get_prompt_cache, hash_key
+from config import OPENAI_API_KEY
+from llm import get_llm
+
+
+# Floats are rounded before rendering: 1234567.8900000001 costs tokens and
+# the answer never quotes more than two decimals anyway
+FLOAT_DECIMALS = 2
+
+
+# tabs/newlines would break the row layout, so they are escaped as in the
+# metadata block
+_ESCAPES = (("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r"))
+
 
+def _escape(text: str) -> str:
+    for raw, escaped in _ESCAPES:
+        text = text.replace(raw, escaped)
+    return text
 
-def rows_to_text(rows: list[dict], columns: list[str], max_rows: int = 20) -> str:
-    """tab-separated string for the prompt and limit rows to 20 for token savings"""
-    if not rows:
+
+def _column_text(col: pa.ChunkedArray) -> pa.Array | pa.ChunkedArray:
+    """One result column rendered to strings by Arrow's vectorised kernels"""
+    if pa.types.is_floating(col.type):
+        col = pc.round(col, FLOAT_DECIMALS)
+    try:
+        text = pc.fill_null(pc.cast(col, pa.string()), "None")
+    except pa.ArrowNotImplementedError:
+        # nested types (lists, structs) have no string cast
+        text = pa.array([str(v) for v in col.to_pylist()], pa.string())
+    for raw, escaped in _ESCAPES:
+        text = pc.replace_substring(text, raw, escaped)
+    return text
+
+
+def preview_for_llm(table: pa.Table, n: int = 20) -> str:
+    """First n rows of an Arrow table as tab-separated text, joined by Arrow's string kernels"""
+    columns = [_column_text(col) for col in table.slice(0, n).columns]
+    rows = pc.binary_join_element_wise(*columns, "\t").to_pylist() if columns else []
+    header = "\t".join(_escape(name) for name in table.column_names)
+    return "\n".join([header, *rows])
+
+
+def rows_to_text(result: pa.Table | None, max_rows: int = 20, total_rows: int | None = None) -> str:
+    """
+    tab-separated string for the prompt and limit rows to 20 for token savings.
+
+    Only the first max_rows rows are rendered. total_rows is the real row
+    count when the table only holds the head of the result.
+    """
+    if result is None or result.num_rows == 0:
         return "(no data)"
-    lines = ["\t".join(str(c) for c in columns)]
-    for row in rows[:max_rows]:
-        lines.append("\t".join(str(row.get(c, "")) for c in columns))
-    if len(rows) > max_rows:
-        lines.append(f"... ({len(rows) - max_rows} more rows)")
-    return "\n".join(lines)
+
+    text = preview_for_llm(result, max_rows)
+    total = result.num_rows if total_rows is None else total_rows
+    if total > max_rows:
+        text += f"\n... ({total - max_rows} more rows)"
+    return text
 
 
 FORMATTER_SYSTEM_PROMPT = """\
@@ -39,25 +83,27 @@ Rules:
 - Do not suggest further analysis unless the data clearly warrants it.
 """
 
+# sha256(user query, sql, rendered rows) -> final answer text
+_ANSWER_CACHE = LRUCache(maxsize=512)
 
-def formatter_agent(state: RetailAgenticState) -> RetailAgenticState:
-    api_key = os.getenv("OPENAI_API_KEY")
+
+async def formatter_agent(state: RetailAgenticState) -> RetailAgenticState:
+    api_key = OPENAI_API_KEY
     if not api_key:
-        return {**state, "final_answer": "Error: OPENAI_API_KEY not set.", "error": "no API key"}
+        return {"final_answer": "Error: OPENAI_API_KEY not set.", "error": "no API key"}
 
-    rows    = state.get("rows", [])
-    columns = state.get("columns", [])
+    result    = state.get("result")
+    row_count = state.get("row_count", 0)
 
     # Retries exhausted with no valid rows — surface the failure reason cleanly
-    if not state.get("validation_passed") and not rows:
+    if not state.get("validation_passed") and not row_count:
         reason = state.get("validation_reason", "Unknown error.")
         return {
-            **state,
             "final_answer": f"I wasn't able to answer that. {reason}",
-            "messages":     state["messages"] + [AIMessage(content="FormatterAgent: error answer")],
+            "messages":     [AIMessage(content="FormatterAgent: error answer")],
         }
 
-    data_text = rows_to_text(rows, columns)
+    data_text = rows_to_text(result, total_rows=row_count)
     prompt = (
         f"User's question: {state['user_query']}\n\n"
         f"SQL executed:\n{state.get('sql', '')}\n\n"
@@ -65,22 +111,33 @@ def formatter_agent(state: RetailAgenticState) -> RetailAgenticState:
         f"Write a clear, business-friendly answer based on these results."
     )
 
+    cache_key = hash_key(state["user_query"], state.get("sql", ""), data_text)
+
+    # A reworded question over the exact same result gets the same answer.
+    # Kept in memory only: the context (rendered rows) is specific to this data.
+    semantic_cache = get_prompt_cache("formatter", persist=False)
+    result_context = hash_key(state.get("sql", ""), data_text)
+
     try:
-        llm = ChatOpenAI(model="gpt-4o-mini", api_key=api_key, temperature=0.3)
-        response = llm.invoke([
-            {"role": "system", "content": FORMATTER_SYSTEM_PROMPT},
-            {"role": "user",   "content": prompt},
-        ])
+        answer = _ANSWER_CACHE.get(cache_key)
+        if answer is None:
+            answer = await asyncio.to_thread(semantic_cache.lookup, state["user_query"], result_context)
+        if answer is None:
+            response = await get_llm("gpt-4o-mini", 0.3).ainvoke([
+                {"role": "system", "content": FORMATTER_SYSTEM_PROMPT},
+                {"role": "user",   "content": prompt},
+            ])
+            answer = response.content.strip()
+            await asyncio.to_thread(semantic_cache.add, cache_key, state["user_query"], answer, result_context)
+        _ANSWER_CACHE.set(cache_key, answer)
         return {
-            **state,
-            "final_answer": response.content.strip(),
+            "final_answer": answer,
             "error": None,
-            "messages": state["messages"] + [AIMessage(content="FormatterAgent: answer generated")],
+            "messages": [AIMessage(content="FormatterAgent: answer generated")],
         }
     except Exception as exc:
         return {
-            **state,
-            "final_answer": f"Results ({len(rows)} rows):\n{data_text}",
+            "final_answer": f"Results ({row_count} rows):\n{data_text}",
             "error": f"formatter LLM failed: {exc}",
-            "messages": state["messages"] + [AIMessage(content=f"FormatterAgent: fallback — {exc}")],
+            "messages": [AIMessage(content=f"FormatterAgent: fallback — {exc}")],
         }
\ No newline at end of file
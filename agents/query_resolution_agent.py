@@ -1,16 +1,20 @@
 from __future__ import annotations
 
-import os
-from dotenv import load_dotenv
-import json
+import asyncio
+import calendar
+import re
+from collections import deque
+from functools import lru_cache
 
-load_dotenv()
-
-from langchain_openai import ChatOpenAI
+import orjson
 from langchain_core.messages import AIMessage
 
 from state import RetailAgenticState
 from models import QueryResolutionOutput
+from dataprocessing.datalayer import NUMERIC_TYPES
+from cache import LRUCache, get_prompt_cache, hash_key
+from config import OPENAI_API_KEY
+from llm import cascade
 
 
 # state for the agent
@@ -25,214 +29,414 @@ from models import QueryResolutionOutput
 
 
 
-def build_metadata_context(table_profile) -> str:
+DATE_TYPES = {"DATE", "TIMESTAMP", "TIMESTAMP WITH TIME ZONE", "TIME"}
+
+# "Order ID", "order_id", "sku-id": key columns, never measures or dimensions
+_KEY_COLUMN_RE = re.compile(r"(?:^|[\s_\-])id$", re.IGNORECASE)
+_DATE_COLUMN_RE = re.compile(r"(?:^|[\s_\-])date(?:$|[\s_\-])", re.IGNORECASE)
+
+
+def _column_hints(col) -> str:
     """
-    Build a structured metadata block for the system_prompt
+    Compact hint flag for a column:
+    G = group-by dimension, D = date, I = identifier, N = numeric measure
     """
+    dtype = col.dtype.upper().split("(")[0].strip()
+    if dtype in DATE_TYPES or _DATE_COLUMN_RE.search(col.name.strip()):
+        return "D"
+    if _KEY_COLUMN_RE.search(col.name.strip()):
+        return "I"
+    if dtype in NUMERIC_TYPES:
+        return "N"
+    return "G"
 
-    column_blocks = []
 
-    for col in table_profile.columns:
-        block = {
-            "name": col.name,
-            "dtype": col.dtype,
-            "distinct_count": col.distinct_count,
-            "null_count": col.null_count,
-            "high_cardinality": col.high_cardinality,
-            "sample_values": col.sample_values[:5],
-            "min_val": col.min_val,
-            "max_val": col.max_val,
-            "avg_val": col.avg_val,
-        }
+# DuckDB type -> short type tag used in the compact metadata rows
+TOON_TYPE_MAP = {
+    "varchar": "str",
+    "text": "str",
+    "boolean": "bool",
+    "tinyint": "int",
+    "smallint": "int",
+    "integer": "int",
+    "bigint": "int",
+    "hugeint": "int",
+    "float": "float",
+    "double": "float",
+    "real": "float",
+    "decimal": "dec",
+    "date": "date",
+    "time": "time",
+    "timestamp": "ts",
+    "timestamp with time zone": "tstz",
+}
 
-        column_blocks.append(block)
 
-    return f"""
-TABLE_NAME: {table_profile.table_name}
-TOTAL_ROWS: {table_profile.total_rows}
+SAMPLE_MAX_CHARS = 32
 
-COLUMN_METADATA:
-{column_blocks}
 
-IMPORTANT:
-- sample_values are illustrative examples only.
-- sample_values do NOT represent all possible values in the column.
-- Use dtype and distinct_count to reason about metrics vs dimensions.
-"""
+def _toon_type(dtype: str) -> str:
+    base = dtype.lower().split("(")[0].strip()
+    return TOON_TYPE_MAP.get(base, dtype)
+
+
+def _toon_cell(value) -> str:
+    # tabs/newlines would break the row layout
+    return str(value).replace("\t", "\\t").replace("\n", "\\n")
+
+
+def _fmt_stat(value: float | None) -> str:
+    return "" if value is None else f"{value:g}"
+
+
+def build_metadata_context(table_profile) -> str:
+    """
+    Build a compact TOON-style metadata block for the prompts: one header of
+    short keys, then one tab-separated row per column.
+    """
+    lines = [
+        f"TABLE_NAME: {table_profile.table_name}",
+        f"TOTAL_ROWS: {table_profile.total_rows}",
+        "n\tt\tdc\tnc\tsv\tmn\tmx\tav\th",
+    ]
 
+    for col in table_profile.columns:
+        # at most 3 distinct samples, each cut to 32 chars: long free-text
+        # values would otherwise dominate the metadata token count
+        samples = ";".join(list(dict.fromkeys(
+            _toon_cell(str(v)[:SAMPLE_MAX_CHARS]) for v in (col.sample_values or [])
+        ))[:3])
+        lines.append("\t".join([
+            _toon_cell(col.name),
+            _toon_type(col.dtype),
+            str(col.distinct_count),
+            str(col.null_count),
+            samples,
+            _fmt_stat(col.min_val),
+            _fmt_stat(col.max_val),
+            _fmt_stat(col.avg_val),
+            _column_hints(col),
+        ]))
+
+    return "\n".join(lines) + "\n"
+
+# Static prefix first, per-turn content last (see the prompt layout note in llm.py)
 SYSTEM_PROMPT = """\
-You are a Language-to-Query Resolution Agent.
-
-Your task:
-Convert a business user's natural language question into a structured query specification.
-
-You are NOT allowed to:
-- Generate SQL.
-- Provide explanations or reasoning.
-- Suggest optional filters.
-- Add extra metrics not requested.
-- Invent columns not in the metadata.
-
-You MUST:
-- Use only the exact column names defined in COLUMN_METADATA.
-- Return strictly structured JSON matching the required schema.
-- Map business terms to actual column names using dtype, statistics, and sample_values.
-- Use lowercase aggregation names: sum, avg, count, min, max.
-- Use exact column names (case-sensitive, including spaces if present).
-- Add one to two lines of commentary on how the query maps to the metadata.
-
-TABLE METADATA:
-{table_metadata}
-
-How to interpret metadata:
-- dtype: physical type (DOUBLE, BIGINT, DATE, VARCHAR, BOOLEAN).
-- distinct_count: cardinality of the column.
-- null_count: rows containing NULL.
-- high_cardinality: distinct_count is large relative to table size.
-- sample_values: illustrative only - do NOT assume these are all possible values.
-
-Interpretation rules:
-- "revenue" or "sales" - numeric monetary column.
-- "quantity" - numeric quantity column.
-- time references (month, quarter, year) - date filters.
-- trend request - group by time unit, include in dimensions.
-- No grouping requested - single aggregated result.
-- Only include dimensions explicitly requested or required for ranking/trend.
-
-If the query intent is "ranking":
-- If user uses words like "top", "highest", "best", apply descending sort.
-- If user uses words like "worst", "lowest", "least", apply ascending sort.
-- If the user explicitly specifies a number (e.g., "top 3", "top 10"), use that as the limit.
-- If the user requests multiple items but does not specify a number (e.g., "top categories", "best segments"), default limit = 5.
-- If the user clearly asks for a single item (e.g., "top category", "best product"), default limit = 1.
-
-Ambiguity Resolution:
-If multiple categorical columns match a business term:
-1. Prefer the column with LOWER distinct_count.
-2. Prefer broader grouping dimensions over granular identifiers.
-3. Only select high-cardinality columns if the user explicitly points to it.
-4. When in doubt, choose the broader business grouping dimension.
-
-{chat_history_block}
-
-Follow-up detection:
-- If CONVERSATION HISTORY is present and the new query is short or references
-  prior context ("same but", "now for", "add", "change", "filter by", etc.),
-  treat it as a modification of the LAST QUERY SPEC in the history.
-- For follow-ups: keep all fields from the last spec unchanged UNLESS the user
-  explicitly modifies them. Only update the fields the user is asking to change.
-- For fresh queries: ignore the history and produce a new spec from scratch.
+You are a Language-to-Query Resolution Agent: turn a business question into a structured query spec.
+
+Never: write SQL; explain; add unrequested filters or metrics; invent columns.
+Always: exact column names from TABLE METADATA (case and spaces); lowercase aggregations sum|avg|count|min|max; 1-2 line comment on how the query maps to the columns.
+
+TABLE METADATA (next system message): a header row, then one tab-separated row per column.
+n=name t=type (str/int/float/dec/bool/date/ts) dc=distinct count nc=null count sv=samples (illustrative, ;-separated) mn/mx/av=min/max/avg h=hints.
+hints: G=group-by dimension, D=date, I=identifier, N=numeric measure.
+
+Mapping:
+- revenue/sales -> numeric monetary column; quantity -> numeric quantity column
+- month/quarter/year -> date filters; trend -> group by time unit (add to dimensions)
+- no grouping asked -> single aggregate; dimensions only if asked or needed for ranking/trend
+
+Ranking:
+- top/highest/best -> desc; worst/lowest/least -> asc
+- explicit N ("top 3") -> limit N; plural without N ("top categories") -> 5; singular ("top category") -> 1
+
+Ambiguous dimension: prefer lower dc; prefer broad groupings (G) over identifiers (I); high-cardinality only if the user names it.
+
+Follow-ups: if CONVERSATION HISTORY is in the user message and the query is short or refers back ("same but", "now for", "add", "change", "filter by"), copy LAST QUERY SPEC and change only the fields the user changes. Otherwise build a fresh spec.
 
 Return structured output only.
 """
 
+# The metadata system message is built once per table and the same str object
+# is reused on every question, so the prompt prefix stays byte-identical.
+@lru_cache(maxsize=32)
+def metadata_system_prompt(table_metadata: str) -> str:
+    return f"TABLE METADATA:\n{table_metadata}"
+
+
+def _dumps(obj, option: int = 0) -> str:
+    # default=str covers Decimal / date values that end up in specs
+    return orjson.dumps(obj, option=option, default=str).decode()
+
+
 MAX_HISTORY = 5
+HISTORY_TOKEN_BUDGET = 1500
+HISTORY_SUMMARY_CHARS = 80
+
+
+@lru_cache(maxsize=1)
+def _encoder():
+    """tiktoken encoder, loaded once. None if the BPE file cannot be fetched."""
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = _encoder()
+    if enc is None:
+        # ~4 characters per token for English text
+        return len(text) // 4 + 1
+    return len(enc.encode(text))
+
 
 def format_chat_history(chat_history: list[dict]) -> str:
     """
-    Render chat history as a block for the resolution agent system prompt.
-    For assistant messages we include both the natural language answer AND
-    the last query_spec so the agent can treat follow-ups as modifications.
+    Render chat history as a block for the resolution agent prompt.
+    The last query_spec is always included in full, since it is the anchor for
+    follow-ups. The newest exchange is kept verbatim and older turns are cut to
+    their first HISTORY_SUMMARY_CHARS characters; turns are dropped oldest
+    first once HISTORY_TOKEN_BUDGET is reached.
     """
     if not chat_history:
         return ""
 
-    lines = ["CONVERSATION HISTORY (most recent last):"]
-    last_spec = None
+    turns = tuple((msg["role"], msg.get("content", "")) for msg in chat_history)
+    last_spec = last_query_spec(chat_history)
+    return _render_chat_history(turns, _dumps(last_spec, orjson.OPT_INDENT_2) if last_spec else "")
 
-    for msg in chat_history:
-        role = msg["role"].upper()
-        content = msg.get("content", "")
-        lines.append(f"  [{role}]: {content}")
-        if msg["role"] == "assistant" and msg.get("query_spec"):
-            last_spec = msg["query_spec"]
 
-    if last_spec:
-        lines.append(
-            f"\n  LAST QUERY SPEC (modify only the fields the user is changing):\n"
-            f"  {json.dumps(last_spec, indent=2)}"
-        )
+# The same history is rendered again on every retry of a question, so the
+# block is memoised on its (role, content) turns plus the last spec.
+@lru_cache(maxsize=64)
+def _render_chat_history(turns: tuple[tuple[str, str], ...], last_spec_json: str) -> str:
+    spec_block = (
+        f"\n  LAST QUERY SPEC (modify only the fields the user is changing):\n"
+        f"  {last_spec_json}"
+        if last_spec_json else ""
+    )
+    budget = HISTORY_TOKEN_BUDGET - count_tokens(spec_block)
+
+    # newest to oldest; the latest user/assistant pair is kept in full
+    kept: list[str] = []
+    for i, (role, content) in enumerate(reversed(turns)):
+        if i >= 2 and len(content) > HISTORY_SUMMARY_CHARS:
+            content = content[:HISTORY_SUMMARY_CHARS] + "..."
+        line = f"  [{role.upper()}]: {content}"
+        budget -= count_tokens(line)
+        if budget < 0 and kept:
+            break
+        kept.append(line)
+
+    lines = ["CONVERSATION HISTORY (most recent last):", *reversed(kept)]
+    if spec_block:
+        lines.append(spec_block)
 
     return "\n".join(lines)
 
-def trim_history(chat_history):
-    max_msgs = MAX_HISTORY * 2
-    return chat_history[-max_msgs:]
+def last_query_spec(chat_history: list[dict]) -> dict | None:
+    """The query_spec of the most recent assistant turn, if any"""
+    for msg in reversed(chat_history):
+        if msg["role"] == "assistant" and msg.get("query_spec"):
+            return msg["query_spec"]
+    return None
+
+def new_history() -> deque[dict]:
+    """Chat history that drops the oldest messages past MAX_HISTORY turns on append"""
+    return deque(maxlen=MAX_HISTORY * 2)
+
+
+# Deterministic fast path for parameter-only follow-ups ("top 10 instead",
+# "now for June", "show the lowest"). A rule only fires when the whole
+# question is made of the rule's match plus filler words, anything else
+# falls through to the LLM.
+_TOP_N_RE = re.compile(r"\b(top|bottom|first)\s+(\d+)\b", re.IGNORECASE)
+_MONTH_RE = re.compile(
+    r"\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)(?:uary|ruary|ch|il|e|y|ust|t|tember|ober|ember)?\b",
+    re.IGNORECASE,
+)
+_SORT_RE = re.compile(r"\b(desc|descending|highest|asc|ascending|lowest|bottom)\b", re.IGNORECASE)
+_FILLER_RE = re.compile(
+    r"\b(now|instead|same|but|for|in|show|me|the|only|just|what|about|and|make|it|change|to|"
+    r"by|of|order|sorted|sort|please|then|ones?|rows?|results?)\b|[^\w\s]",
+    re.IGNORECASE,
+)
+_YEAR_RE = re.compile(r"^(\d{4})-")
+_MONTHS = {m.lower(): i for i, m in enumerate(calendar.month_abbr) if m}
+
+
+def _patch_month(spec: dict, month: int) -> bool:
+    for f in spec.get("filters") or []:
+        values = f.get("value")
+        if f.get("operator") != "between" or not isinstance(values, list) or len(values) != 2:
+            continue
+        m = _YEAR_RE.match(str(values[0]))
+        if not m:
+            continue
+        year = int(m.group(1))
+        last_day = calendar.monthrange(year, month)[1]
+        f["value"] = [f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last_day:02d}"]
+        return True
+    return False
+
+
+def try_patch_last_spec(user_query: str, last_spec: dict) -> QueryResolutionOutput | None:
+    """
+    Apply a limit / month / sort-direction tweak to the previous query spec
+    without an LLM call. Returns None when the question needs the model.
+    """
+    if not last_spec:
+        return None
+
+    spec = orjson.loads(_dumps(last_spec))
+    rest = user_query
+    fired = False
+
+    if m := _TOP_N_RE.search(rest):
+        spec["limit"] = int(m.group(2))
+        if m.group(1).lower() == "bottom":
+            if not spec.get("sort"):
+                return None
+            for sort in spec["sort"]:
+                sort["direction"] = "asc"
+        rest = rest[:m.start()] + rest[m.end():]
+        fired = True
+
+    if m := _MONTH_RE.search(rest):
+        if not _patch_month(spec, _MONTHS[m.group(1).lower()]):
+            return None
+        rest = rest[:m.start()] + rest[m.end():]
+        fired = True
+
+    if m := _SORT_RE.search(rest):
+        if not spec.get("sort"):
+            return None
+        direction = "asc" if m.group(1).lower() in ("asc", "ascending", "lowest", "bottom") else "desc"
+        for sort in spec["sort"]:
+            sort["direction"] = direction
+        rest = rest[:m.start()] + rest[m.end():]
+        fired = True
+
+    if not fired or _FILLER_RE.sub("", rest).strip():
+        return None
+
+    try:
+        return QueryResolutionOutput.model_validate(spec)
+    except Exception:
+        return None
+
+
+# static tail of every user message
+_USER_SUFFIX = "\n\nReturn the structured output now.\n"
+
+# sha256(system prompt, csv content hash, user message) -> QueryResolutionOutput json
+_RESOLUTION_CACHE = LRUCache(maxsize=512)
+
+
+def _table_prompt_cache(state: RetailAgenticState):
+    return get_prompt_cache(hash_key(state["table_name"], state["content_hash"])[:16])
+
+
+def _semantic_context(state: RetailAgenticState) -> str:
+    # the previous turn's spec: paraphrases only match under the same anchor
+    return _dumps(last_query_spec(state.get("chat_history", [])), orjson.OPT_SORT_KEYS)
 
 
 # Agent Node
-def query_resolution_agent(state: RetailAgenticState) -> RetailAgenticState:
+async def query_resolution_agent(state: RetailAgenticState) -> RetailAgenticState:
     """
     Language-to-Query Resolution Agent.
 
     Reads the user query + table metadata from state and produces
     a structured QueryResolutionOutput.
     """
-    openai_key = os.getenv("OPENAI_API_KEY")
+    openai_key = OPENAI_API_KEY
 
     if not openai_key:
         return {
-            **state,
             "error": "OPENAI_API_KEY environment variable not set.",
-            "messages": state["messages"] + [AIMessage(content="QueryResolutionAgent: failed — no API key")],
+            "messages": [AIMessage(content="QueryResolutionAgent: failed — no API key")],
         }
     
-    llm = ChatOpenAI(
-        model = "gpt-5-mini",
-        api_key=openai_key,
-        temperature=0
-    )
-
-    structured_llm = llm.with_structured_output(QueryResolutionOutput)
-
     chat_history_block = format_chat_history(state.get("chat_history", []))
-
-
-
-    system_prompt = SYSTEM_PROMPT.format(
-        table_metadata=state["table_metadata"],
-        chat_history_block = chat_history_block
-        )
+    metadata_prompt = metadata_system_prompt(state["table_metadata"])
 
     feedback = state.get("validation_feedback")
 
-    user_content = f"""
-User Query: {state["user_query"]}
+    if not feedback:
+        patched = try_patch_last_spec(state["user_query"], last_query_spec(state.get("chat_history", [])))
+        if patched is not None:
+            return {
+                "resolution": patched,
+                "resolution_cache_key": "",
+                "error": None,
+                "messages": [AIMessage(content="QueryResolutionAgent: patched last query spec (no LLM call)")],
+            }
+
+    user_content = chat_history_block + "\n\nUser Query: " + state["user_query"]
+    if feedback:
+        user_content += "\n\n[PREVIOUS ATTEMPT FAILED: " + feedback + ". Adjust query spec to fix this.]"
+    user_content += _USER_SUFFIX
 
-Return the structured output now.
-"""
+    cache_key = hash_key(SYSTEM_PROMPT, state["content_hash"], user_content)
+
+    # Persistent exact + semantic cache, one per table, keyed on the csv's
+    # content hash. Paraphrases only match under the same follow-up anchor.
+    # Retries must always reach the LLM, so the persistent cache is skipped
+    # then.
+    prompt_cache = None
+    if not feedback:
+        prompt_cache = _table_prompt_cache(state)
+        semantic_context = _semantic_context(state)
 
-    if feedback:
-        user_content = (
-            f"{state['user_query']}\n\n"
-            f"[PREVIOUS ATTEMPT FAILED: {feedback}. Adjust query spec to fix this.]\n\n"
-            "Return the structured output now."
-        )
-    
     try:
-        result: QueryResolutionOutput = structured_llm.invoke([
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content},
-        ])
+        cached = _RESOLUTION_CACHE.get(cache_key)
+        if cached is None and prompt_cache is not None:
+            cached = await asyncio.to_thread(
+                lambda: prompt_cache.get(cache_key) or prompt_cache.lookup(state["user_query"], semantic_context)
+            )
+            if cached is not None:
+                _RESOLUTION_CACHE.set(cache_key, cached)
+
+        # Cached specs have passed validation before; a new one is only
+        # cached (in memory and in the persistent exact + semantic cache) by
+        # remember_resolution once it has. Retried specs are not cached at
+        # all: their key carries the validation feedback.
+        pending_key = ""
+        if cached is not None:
+            result = QueryResolutionOutput.model_validate_json(cached)
+        else:
+            result = await cascade(QueryResolutionOutput, [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "system", "content": metadata_prompt},
+                {"role": "user", "content": user_content},
+            ], escalate=bool(feedback), cache_key=f"resolution:{state['table_name']}")
+            if not feedback:
+                pending_key = cache_key
 
         return {
-            **state,
             "resolution": result,
+            "resolution_cache_key": pending_key,
             "error": None,
-            "messages": state["messages"] + [
+            "messages": [
                 AIMessage(content=f"QueryResolutionAgent: resolved query → {len(result.relevant_columns)} columns, sql_hint ready")
             ]
         }
     
     except Exception as exc:
         return {
-            **state,
             "error": f"query_resolution_agent failed: {exc}",
-            "messages": state["messages"] + [AIMessage(content=f"QueryResolutionAgent: error — {exc}")],
+            "messages": [AIMessage(content=f"QueryResolutionAgent: error — {exc}")],
         }
     
 
 
+async def remember_resolution(state: RetailAgenticState) -> None:
+    """Cache this run's new spec; called by validation once the result passed"""
+    key = state.get("resolution_cache_key")
+    resolution = state.get("resolution")
+    if not key or resolution is None:
+        return
+    spec_json = resolution.model_dump_json()
+    _RESOLUTION_CACHE.set(key, spec_json)
+    await asyncio.to_thread(
+        _table_prompt_cache(state).add, key, state["user_query"], spec_json, _semantic_context(state)
+    )
+
+
+
 
 # testing the agent
 # def build_query_resolution_graph() -> StateGraph:
@@ -1,14 +1,18 @@
 from __future__ import annotations
 
-import json
-import os
-from typing import Any
+import asyncio
+import io
+import math
+from decimal import Decimal
+from itertools import islice
+from typing import Any, Iterator
 
-from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
-load_dotenv()
+from agents.data_extraction_agent import table_system_prompt, strip_sql_fences
+from config import USE_LLM_FORMATTER
+from llm import get_llm, structured_llm
+from cache import get_prompt_cache, hash_key
 
 
 # Output model for the summarizer function
@@ -56,76 +60,189 @@ Rules for SQL:
 
 
 # Pass the metadata to the llm and let it decide the sql queries for various metrics.
-def plan_summary_queries(metadata_str: str, table_name: str) -> list[SummaryQuery]:
-    api_key = os.getenv("OPENAI_API_KEY")
-    llm = ChatOpenAI(
-        model="gpt-5-mini", 
-        api_key=api_key, 
-        temperature=0)
-    structured = llm.with_structured_output(SummaryQueryPlan)
-
-    prompt = f"""Table name: {table_name}
-
-Metadata:
-{metadata_str}
-
-Generate the SQL queries that will power a comprehensive business summary of this dataset.
-"""
-    
-    result: SummaryQueryPlan = structured.invoke([
+async def aplan_summary_queries(metadata_str: str, table_name: str) -> list[SummaryQuery]:
+    # Static prefix first, request last (see the prompt layout note in llm.py)
+    table_prompt = table_system_prompt(table_name, metadata_str)
+    prompt = "Generate the SQL queries that will power a comprehensive business summary of this dataset."
+
+    # Same metadata -> same plan; re-uploading a file skips the LLM call
+    prompt_cache = get_prompt_cache("summary_plan")
+    cache_key = hash_key(SYSTEM_PROMPT, table_prompt, prompt)
+    cached = await asyncio.to_thread(prompt_cache.get, cache_key)
+    if cached is not None:
+        return SummaryQueryPlan.model_validate_json(cached).queries
+
+    result: SummaryQueryPlan = await structured_llm("gpt-5-mini", SummaryQueryPlan).ainvoke([
         {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": table_prompt},
         {"role": "user",   "content": prompt},
     ])
+    await asyncio.to_thread(prompt_cache.set, cache_key, result.model_dump_json())
 
     return result.queries
 
 
-# Execute the generated sql queries against the the duckdb connection
-def execute_summary_queries(queries: list[SummaryQuery], db_con: Any) -> list[dict]:
-    results = []
-    
-    for q in queries:
-        try:
-            # removing any trailing fluff producd by the llm
-            sql = q.sql.strip().removeprefix("```sql").removeprefix("```").removesuffix("```").strip()
-            
-            res = db_con.execute(sql)
+def plan_summary_queries(metadata_str: str, table_name: str) -> list[SummaryQuery]:
+    return asyncio.run(aplan_summary_queries(metadata_str, table_name))
 
+
+SUMMARY_MAX_ROWS = 200
+
+
+def _run_summary_query(q: SummaryQuery, db_con: Any) -> dict:
+    try:
+        # removing any trailing fluff producd by the llm
+        sql = strip_sql_fences(q.sql)
+
+        # DuckDB needs one cursor per thread; the cursors share the database
+        cur = db_con.cursor()
+        try:
+            res = cur.execute(sql)
             columns = [d[0] for d in res.description]
-            rows = [dict(zip(columns, row)) for row in res.fetchall()]
-
-            results.append({
-                "title":   q.title,
-                "sql":     sql,
-                "columns": columns,
-                "rows":    rows,
-            })
-        except Exception as e:
-            results.append({
-                "title":   q.title,
-                "sql":     q.sql,
-                "columns": [],
-                "rows":    [],
-                "error":   str(e),
-            })
+            # only the head is ever rendered; stop DuckDB producing tuples early
+            rows = res.fetchmany(SUMMARY_MAX_ROWS + 1)
+            truncated = len(rows) > SUMMARY_MAX_ROWS
+            del rows[SUMMARY_MAX_ROWS:]
+        finally:
+            cur.close()
+
+        return {
+            "title":   q.title,
+            "sql":     sql,
+            "columns": columns,
+            # column-major: one list per column, no per-row dicts
+            "data":    [list(col) for col in zip(*rows)],
+            "row_count": len(rows),
+            "truncated": truncated,
+        }
+    except Exception as e:
+        return {
+            "title":   q.title,
+            "sql":     q.sql,
+            "columns": [],
+            "data":    [],
+            "row_count": 0,
+            "error":   str(e),
+        }
+
+
+# Execute the generated sql queries against the the duckdb connection.
+# The queries are independent, so they run concurrently (one worker thread
+# and cursor per query); results keep the order of the plan so the report
+# sections stay stable.
+async def aexecute_summary_queries(queries: list[SummaryQuery], db_con: Any) -> list[dict]:
+    return list(await asyncio.gather(
+        *(asyncio.to_thread(_run_summary_query, q, db_con) for q in queries)
+    ))
 
-    return results
+
+def table_schema_hash(db_con: Any, table_name: str) -> str:
+    """Hash of the table's column names + types (not its data or samples)"""
+    cols = db_con.execute(f"DESCRIBE {table_name}").fetchall()
+    return hash_key(table_name, *(f"{name} {dtype}" for name, dtype, *_ in cols))
 
 
 # Convert the metrics retrieved into a well formatted markdown report.
+def _cell(value: Any) -> str:
+    # floats / decimals: whole numbers without decimals, the rest to two
+    # places with thousands separators (78592678.3000001 -> 78,592,678.30)
+    if isinstance(value, (float, Decimal)) and math.isfinite(value):
+        return f"{value:.0f}" if value == int(value) else f"{value:,.2f}"
+    return str(value)
+
+
+def _truncation_note(r: dict, shown: int) -> str:
+    # the query hit SUMMARY_MAX_ROWS, so row_count is not the real total
+    if not r.get("truncated"):
+        return ""
+    return f"Query returned more than {SUMMARY_MAX_ROWS} rows; showing the first {min(shown, r['row_count'])}."
+
+
 def results_to_text(results: list[dict]) -> str:
-    sections = []
+    buf = io.StringIO()
     for r in results:
-        if r.get("error") or not r["rows"]:
+        if r.get("error") or not r["row_count"]:
             continue
-        lines = [f"### {r['title']}"]
-        header = " | ".join(r["columns"])
-        sep    = " | ".join("---" for _ in r["columns"])
-        lines += [header, sep]
-        for row in r["rows"][:10]:
-            lines.append(" | ".join(str(row.get(c, "")) for c in r["columns"]))
-        sections.append("\n".join(lines))
-    return "\n\n".join(sections)
+        columns = r["columns"]
+        if buf.tell():
+            buf.write("\n\n")
+        buf.write(f"### {r['title']}\n")
+        buf.write(" | ".join(columns))
+        buf.write("\n")
+        buf.write(" | ".join("---" for _ in columns))
+        for row in islice(zip(*r["data"]), 10):
+            buf.write("\n")
+            buf.write(" | ".join(map(_cell, row)))
+        if note := _truncation_note(r, 10):
+            buf.write(f"\n({note})")
+    return buf.getvalue()
+
+_METRIC_PREFIXES = ("total", "average", "avg", "overall", "number", "count", "unique")
+_RANKING_PREFIXES = ("top", "bottom", "best", "worst", "highest", "lowest", "least", "most")
+_TREND_WORDS = ("trend", "month", "monthly", "daily", "weekly", "over time", "by date", "by day", "by week")
+
+
+def _section_for(r: dict) -> str:
+    title = r["title"].lower()
+    if title.startswith(_RANKING_PREFIXES):
+        return "Top Performers"
+    if any(w in title for w in _TREND_WORDS) or any(
+        "date" in c.lower() or "month" in c.lower() for c in r["columns"]
+    ):
+        return "Trends"
+    if r["row_count"] == 1 or title.startswith(_METRIC_PREFIXES):
+        return "Key Metrics"
+    return "Breakdown & Distribution"
+
+
+def _markdown_table(r: dict, max_rows: int = 5) -> str:
+    lines = [
+        "| " + " | ".join(r["columns"]) + " |",
+        "|" + "---|" * len(r["columns"]),
+    ]
+    lines += [
+        "| " + " | ".join(_cell(v).replace("|", "\\|") for v in row) + " |"
+        for row in islice(zip(*r["data"]), max_rows)
+    ]
+    if note := _truncation_note(r, max_rows):
+        lines.append(f"\n_{note}_")
+    return "\n".join(lines)
+
+
+def format_markdown_fast(results: list[dict], table_name: str) -> str:
+    """
+    Deterministic report: each query result is placed under a fixed heading
+    picked from its title (Total ... -> Key Metrics, Top ... -> Top Performers,
+    monthly/date results -> Trends, the rest -> Breakdown & Distribution).
+    """
+    ok = [r for r in results if not r.get("error") and r["row_count"]]
+    if not ok:
+        return "# Summary\n\nNo data could be extracted from the uploaded file."
+
+    sections: dict[str, list[str]] = {
+        "Key Metrics": [],
+        "Top Performers": [],
+        "Breakdown & Distribution": [],
+        "Trends": [],
+    }
+    for r in ok:
+        section = _section_for(r)
+        if section == "Key Metrics" and r["row_count"] == 1:
+            values = ", ".join(f"{c}: {_cell(col[0])}" for c, col in zip(r["columns"], r["data"]))
+            sections[section].append(f"- **{r['title']}** — {values}")
+        else:
+            sections[section].append(f"### {r['title']}\n\n{_markdown_table(r)}")
+
+    parts = [
+        "## Executive Summary",
+        f"Automated summary of `{table_name}` built from {len(ok)} of {len(results)} planned queries.",
+    ]
+    for heading, body in sections.items():
+        if body:
+            sep = "\n" if heading == "Key Metrics" else "\n\n"
+            parts.append(f"## {heading}\n\n" + sep.join(body))
+    return "\n\n".join(parts)
+
 
 FORMATTING_SYSTEM_PROMPT = """\
 You are a senior business analyst writing an executive data summary.
@@ -159,9 +276,9 @@ Rules:
 - Write for a business audience, not a technical one.
 """  
 
-def format_markdown(results: list[dict], table_name: str) -> str:
-    api_key = os.getenv("OPENAI_API_KEY")
-    llm = ChatOpenAI(model="gpt-4o-mini", api_key=api_key, temperature=0.3)
+async def aformat_markdown(results: list[dict], table_name: str) -> str:
+    if not USE_LLM_FORMATTER:
+        return format_markdown_fast(results, table_name)
 
     data_text = results_to_text(results)
     if not data_text.strip():
@@ -174,18 +291,78 @@ Query results:
 
 Write the business summary report in markdown.
 """
-    response = llm.invoke([
+    response = await get_llm("gpt-4o-mini", 0.3).ainvoke([
         {"role": "system", "content": FORMATTING_SYSTEM_PROMPT},
         {"role": "user",   "content": prompt},
     ])
     return response.content.strip()
 
 
+def format_markdown_stream(results: list[dict], table_name: str) -> Iterator[str]:
+    """Stream the report as it is generated, e.g. into st.write_stream"""
+    if not USE_LLM_FORMATTER:
+        yield format_markdown_fast(results, table_name)
+        return
+
+    data_text = results_to_text(results)
+    if not data_text.strip():
+        yield "# Summary\n\nNo data could be extracted from the uploaded file."
+        return
+
+    prompt = f"""Dataset: {table_name}
+
+Query results:
+{data_text}
+
+Write the business summary report in markdown.
+"""
+    for chunk in get_llm("gpt-4o-mini", 0.3, streaming=True).stream([
+        {"role": "system", "content": FORMATTING_SYSTEM_PROMPT},
+        {"role": "user",   "content": prompt},
+    ]):
+        if chunk.content:
+            yield chunk.content
+
+
+def format_markdown(results: list[dict], table_name: str) -> str:
+    return "".join(format_markdown_stream(results, table_name)).strip()
+
+
+async def acollect_summary_results(metadata_str: str, table_name: str, db_con: Any) -> list[dict]:
+    """
+    Plan the summary queries and run them; the report is written separately.
+    Queries that ran cleanly are stored per table schema, so a file with the
+    same columns but different data also skips planning.
+    """
+    schema_store = get_prompt_cache("summary_schema")
+    schema_key = await asyncio.to_thread(table_schema_hash, db_con, table_name)
+    stored = await asyncio.to_thread(schema_store.get, schema_key)
+
+    if stored is not None:
+        queries = SummaryQueryPlan.model_validate_json(stored).queries
+    else:
+        queries = await aplan_summary_queries(metadata_str, table_name)
+    results = await aexecute_summary_queries(queries, db_con)
+
+    validated = [q for q, r in zip(queries, results) if not r.get("error")]
+    if validated and stored is None:
+        plan = SummaryQueryPlan(queries=validated)
+        await asyncio.to_thread(schema_store.set, schema_key, plan.model_dump_json())
+    return results
+
+
+async def agenerate_summary(metadata_str: str, table_name: str, db_con: Any) -> str:
+    """
+    Plan (LLM) -> run the planned queries concurrently (DuckDB, worker
+    threads) -> write the report (LLM).
+    """
+    results = await acollect_summary_results(metadata_str, table_name, db_con)
+    return await aformat_markdown(results, table_name)
+
+
 # Main entrypoint for the streamlit interface and the main thread
 def generate_summary(metadata_str: str, table_name: str, db_con: Any) -> str:
     """
     Called once after file upload; result cached for further use
     """
-    queries = plan_summary_queries(metadata_str, table_name)
-    results = execute_summary_queries(queries, db_con)
-    return format_markdown(results, table_name)
\ No newline at end of file
+    return asyncio.run(agenerate_summary(metadata_str, table_name, db_con))
\ No newline at end of file
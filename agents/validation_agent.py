@@ -1,18 +1,23 @@
 from __future__ import annotations
 
-import os
-from dotenv import load_dotenv
-import json
+import asyncio
+import io
+import weakref
+from contextvars import ContextVar
+from itertools import islice
 
-load_dotenv()
-
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import AIMessage
 
 from state import RetailAgenticState
-from models import ValidationOutput
+from models import BatchValidationOutput, ValidationOutput
+from config import OPENAI_API_KEY
+from llm import structured_llm
+from cache import get_prompt_cache, hash_key
+from agents.query_resolution_agent import remember_resolution
+from agents.data_extraction_agent import remember_sql, result_rule_failure
 
 
+# Static prefix first, per-question items in the user message (see llm.py)
 SYSTEM_PROMPT = """\
 You are a data validation agent. Your job is to verify that a SQL query result
 correctly and completely answers a user's business question.
@@ -37,91 +42,214 @@ Fail conditions to check:
 
 If the result looks reasonable (even if imperfect), pass it.
 Do not fail on minor formatting or ordering issues.
+
+Results are given as numbered items (### item 0, ### item 1, ...); return
+exactly one result per item, in the same order.
 """
 
-def rows_to_text(rows: list[dict], columns: list[str], max_rows: int = 20) -> str:
-    """Serialise result rows into a compact tab-separated string for the prompt."""
-    if not rows:
+def sample_rows_text(data: list[list], columns: list[str], max_rows: int = 20) -> str:
+    """
+    Serialise column-major result data (one list per column) into a compact
+    tab-separated string for the prompt.
+    """
+    if not data or not data[0]:
         return "(no data)"
-    lines = ["\t".join(str(c) for c in columns)]
-    for row in rows[:max_rows]:
-        lines.append("\t".join(str(row.get(c, "")) for c in columns))
-    if len(rows) > max_rows:
-        lines.append(f"... ({len(rows) - max_rows} more rows)")
-    return "\n".join(lines)
-
-def validation_agent(state: RetailAgenticState) -> RetailAgenticState:
+    buf = io.StringIO()
+    buf.write("\t".join(map(str, columns)))
+    for row in islice(zip(*data), max_rows):
+        buf.write("\n")
+        buf.write("\t".join(map(str, row)))
+    if len(data[0]) > max_rows:
+        buf.write(f"\n... ({len(data[0]) - max_rows} more rows)")
+    return buf.getvalue()
+
+
+def _sample_data(state: RetailAgenticState, n: int = 10) -> list[list]:
+    """First n result rows, column-major, straight from the Arrow result"""
+    table = state.get("result")
+    if table is None:
+        return []
+    return [col.to_pylist() for col in table.slice(0, n).columns]
+
+_ASSESS_SUFFIX = """
+
+Assess whether each result correctly answers the question.
+If it does not, identify whether the problem is in the query spec (route to query_resolution)
+or in the SQL generation (route to data_extraction).
+"""
+
+
+def _render_item(i: int, item: dict) -> str:
+    data = item.get("data") or []
+    sample_text = sample_rows_text(data, item.get("columns", []), max_rows=10) if data and data[0] else "(no rows returned)"
+    question = f"Question: {item['question']}\n" if item.get("question") else ""
+    spec = f"Query specification:\n{item['spec_json']}\n" if item.get("spec_json") else ""
+    return f"""### item {i}
+{question}{spec}SQL:
+{item.get("sql", "")}
+
+Rows returned: {item.get("row_count", len(data[0]) if data else 0)}
+
+Result sample (up to 10 rows):
+{sample_text}"""
+
+
+async def validate_batch(
+    items: list[dict],
+    question: str = "",
+    spec_json: str = "",
+) -> list[ValidationOutput]:
+    """
+    Validate several (sql, columns, data, row_count) results in one LLM call;
+    data is column-major (one list per column).
+    question / spec_json apply to every item and are sent once; an item may
+    carry its own "question" / "spec_json" instead. Returns one
+    ValidationOutput per item.
+    """
+    header = ""
+    if question:
+        header += f"User's question: {question}\n\n"
+    if spec_json:
+        header += f"Query specification (from resolution agent):\n{spec_json}\n\n"
+
+    body = "\n\n".join(_render_item(i, item) for i, item in enumerate(items))
+    prompt = header + body + _ASSESS_SUFFIX
+
+    # Exact-match only: the prompt carries the SQL and the result samples, so
+    # a hit means the same questions produced the same data before. Only
+    # all-pass batches are stored, so a retry is always re-judged.
+    prompt_cache = get_prompt_cache("validation")
+    cache_key = hash_key(SYSTEM_PROMPT, prompt)
+
+    cached = await asyncio.to_thread(prompt_cache.get, cache_key)
+    if cached is not None:
+        return BatchValidationOutput.model_validate_json(cached).results
+
+    response: BatchValidationOutput = await structured_llm("gpt-5-mini", BatchValidationOutput).ainvoke([
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user",   "content": prompt},
+    ])
+    if len(response.results) != len(items):
+        raise ValueError(f"expected {len(items)} validation results, got {len(response.results)}")
+
+    if all(r.passed for r in response.results):
+        await asyncio.to_thread(prompt_cache.set, cache_key, response.model_dump_json())
+    return response.results
+
+
+# Seconds a validation waits for other questions of the same batch run
+# (graph.run_graph_batch sets it) before the pending items are validated in
+# one validate_batch call. 0 = validate alone, straight away.
+VALIDATION_BATCH_WINDOW: ContextVar[float] = ContextVar("VALIDATION_BATCH_WINDOW", default=0.0)
+
+
+class _ValidationBatcher:
+    """Collects the items validated on one event loop within the window"""
+
+    def __init__(self):
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._flush: asyncio.Task | None = None
+
+    async def submit(self, item: dict, window: float) -> ValidationOutput:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) == 1:
+            self._flush = asyncio.create_task(self._flush_after(window))
+        return await future
+
+    async def _flush_after(self, window: float) -> None:
+        await asyncio.sleep(window)
+        batch, self._pending = self._pending, []
+        try:
+            results = await validate_batch([item for item, _ in batch])
+        except Exception as exc:
+            results = [exc] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():       # its question was cancelled meanwhile
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+_BATCHERS: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _ValidationBatcher] = weakref.WeakKeyDictionary()
+
+
+async def _validate_one(item: dict) -> ValidationOutput:
+    window = VALIDATION_BATCH_WINDOW.get()
+    if not window:
+        [response] = await validate_batch([item])
+        return response
+    batcher = _BATCHERS.setdefault(asyncio.get_running_loop(), _ValidationBatcher())
+    return await batcher.submit(item, window)
+
+
+def _deterministic_validate(state: RetailAgenticState) -> ValidationOutput | None:
+    """
+    Rule checks that settle a FAIL without the LLM. Returns None otherwise:
+    whether the result answers the question (right metric, filter,
+    aggregation) is always left to the model.
+    """
+    table = state.get("result")
+    resolution = state.get("resolution")
+    if table is None or resolution is None:
+        return None
+
+    reason = result_rule_failure(table, resolution)
+    if reason is None:
+        return None
+    return ValidationOutput(passed=False, reason=reason, route_to="data_extraction")
+
+
+async def validation_agent(state: RetailAgenticState) -> RetailAgenticState:
     """Validates the output of the previous agents"""
 
-    api_key    = os.getenv("OPENAI_API_KEY")
+    api_key    = OPENAI_API_KEY
     if not api_key:
-        return {**state, "error": "OPENAI_API_KEY not set.",
-                "messages": state["messages"] + [AIMessage(content="DataExtractionAgent: no API key")]}
+        return {"error": "OPENAI_API_KEY not set.",
+                "messages": [AIMessage(content="DataExtractionAgent: no API key")]}
     
     if state.get("error"):
         reason = f"SQL execution failed: {state['error']}"
         ext_retries = state.get("extraction_retry_count", 0)
         return {
-            **state,
             "validation_passed": False,
             "validation_reason": reason,
             "validation_feedback": reason,
             "route_to": "data_extraction",
+            "failure_stage": "execution",
             "extraction_retry_count": ext_retries + 1,
-            "messages": state["messages"] + [
+            "messages": [
                 AIMessage(content=f"ValidationAgent: FAIL SQL error → retry data_extraction")
             ],
         }
 
     resolution = state.get("resolution")
-    rows = state.get("rows", [])
-    columns = state.get("columns", [])
-    sql = state.get("sql", "")
-
-    sample_text = rows_to_text(rows[:10], columns) if rows else "(no rows returned)"
-    
-    prompt = f"""
-    User's question: {state['user_query']}
-
-Query specification (from resolution agent):
-{json.dumps(resolution.model_dump(), indent=2)}
-
-SQL generated (from data extraction agent):
-{sql}
-
-Rows returned: {len(rows)}
-
-Result sample (up to 10 rows):
-{sample_text}
-
-Assess whether this result correctly answers the user's question.
-If it does not, identify whether the problem is in the query spec (route to query_resolution)
-or in the SQL generation (route to data_extraction).
-"""
-
-    llm = ChatOpenAI(
-        model = "gpt-5-mini",
-        api_key=api_key,
-        temperature=0
-    )
-
-    structured_llm = llm.with_structured_output(ValidationOutput)
-
+    table = state.get("result")
     try:
-        response: ValidationOutput = structured_llm.invoke([
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user",   "content": prompt},
-        ])
+        response = _deterministic_validate(state)
+        if response is None:
+            response = await _validate_one({
+                "question": state["user_query"],
+                "spec_json": resolution.model_dump_json(),
+                "sql": state.get("sql", ""),
+                "columns": table.column_names if table is not None else [],
+                "data": _sample_data(state),
+                "row_count": state.get("row_count", 0),
+            })
 
         if response.passed:
+            await remember_resolution(state)
+            remember_sql(state)
             return {
-                **state,
                 "validation_passed": True,
                 "validation_reason": response.reason,
                 "validation_feedback": "",
                 "route_to": "",
+                "failure_stage": "",
                 "error": None,
-                "messages": state["messages"] + [
+                "messages": [
                     AIMessage(content=f"ValidationAgent: PASS - {response.reason[:80]}")
                 ],
             }
@@ -130,25 +258,24 @@ or in the SQL generation (route to data_extraction).
             res_retries = state.get("resolution_retry_count", 0)
             ext_retries = state.get("extraction_retry_count", 0)
             return {
-                **state,
                 "validation_passed": False,
                 "validation_reason": response.reason,
                 "validation_feedback": response.reason,
                 "route_to": route,
+                "failure_stage": "resolution" if route == "query_resolution" else "sql",
                 "resolution_retry_count": res_retries + (1 if route == "query_resolution" else 0),
                 "extraction_retry_count": ext_retries + (1 if route == "data_extraction"  else 0),
-                "messages": state["messages"] + [
+                "messages": [
                     AIMessage(content=f"ValidationAgent: FAIL -> retry {route} - {response.reason[:80]}")
                 ],
             }
     
     except Exception as exc:
         return {
-            **state,
             "validation_passed": True,
             "validation_reason": f"Validation LLM failed ({exc}), passing through.",
             "validation_feedback": "",
-            "messages": state["messages"] + [
+            "messages": [
                 AIMessage(content=f"ValidationAgent: LLM error, passing through — {exc}")
             ],
         }
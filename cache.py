@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+
+def hash_key(*parts: str) -> str:
+    """sha256 over the prompt parts, used as a content-addressed cache key"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+# Small thread-safe LRU used to skip repeated LLM round-trips.
+# Values are stored serialised (json / plain str) so cached pydantic objects
+# can never be mutated by a caller. With `maxbytes`, entries are also evicted
+# once the `sizeof` of the cached values adds up to more than that.
+class LRUCache:
+    def __init__(self, maxsize: int = 512, maxbytes: int | None = None,
+                 sizeof: Callable[[Any], int] | None = None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._data: OrderedDict[str, Any] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            if key in self._data:
+                self._nbytes -= self._sizeof(self._data[key])
+            self._data[key] = value
+            self._nbytes += self._sizeof(value)
+            self._data.move_to_end(key)
+            while self._data and (len(self._data) > self.maxsize
+                                  or (self.maxbytes is not None and self._nbytes > self.maxbytes)):
+                _, evicted = self._data.popitem(last=False)
+                self._nbytes -= self._sizeof(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+
+CACHE_DIR = Path(os.getenv("CACHE_DIR", Path(__file__).parent / "cache"))
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.95
+
+_LITERAL_RE = re.compile(
+    r"\d+(?:\.\d+)?|\b(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|"
+    r"sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b",
+    re.IGNORECASE,
+)
+
+
+def _literals(text: str) -> list[str]:
+    """Numbers and month names of a question (months by 3-letter prefix), sorted"""
+    return sorted(t.lower()[:3] if t[0].isalpha() else t for t in _LITERAL_RE.findall(text))
+
+
+@lru_cache(maxsize=1)
+def _embedder() -> OpenAIEmbeddings:
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL)
+
+
+@lru_cache(maxsize=2048)
+def embed(text: str) -> np.ndarray:
+    """Unit-normalised embedding of a user question, cached locally"""
+    vec = np.asarray(_embedder().embed_query(text), dtype=np.float32)
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+
+# Two-tier prompt cache, persisted in SQLite:
+#   1. exact   - sha256 of the prompt parts -> response json
+#   2. semantic - paraphrased questions ("top 5 categories by revenue" vs
+#      "5 highest-grossing categories") matched by embedding cosine similarity.
+# Embeddings are stacked in one matrix so a lookup is a single matrix-vector
+# product. Each semantic entry carries a context key (e.g. the previous query
+# spec) and only entries with the same context can match, so follow-ups never
+# reuse an answer given under different history.
+# Embeddings barely separate "top 5" from "top 10" or 2021 from 2022, so a
+# semantic hit is only accepted when the numbers and month names of the two
+# questions are identical (see _literals).
+class PromptCache:
+    def __init__(self, path: Path | None = None, threshold: float = SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._keys: list[bytes] = []
+        self._contexts: list[str] = []
+        self._literals: list[list[str] | None] = []
+        self._values: list[str] = []
+        self._lock = threading.Lock()
+
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path) if path else ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key BLOB PRIMARY KEY, context TEXT NOT NULL, embedding BLOB, response_json TEXT NOT NULL, "
+            "question TEXT)"
+        )
+        # files written before the question column existed
+        if "question" not in {r[1] for r in self._db.execute("PRAGMA table_info(entries)")}:
+            self._db.execute("ALTER TABLE entries ADD COLUMN question TEXT")
+        rows = self._db.execute(
+            "SELECT key, context, embedding, response_json, question FROM entries WHERE embedding IS NOT NULL"
+        ).fetchall()
+        if rows:
+            self._matrix = np.stack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+            self._keys = [r[0] for r in rows]
+            self._contexts = [r[1] for r in rows]
+            self._values = [r[3] for r in rows]
+            # entries without a stored question can never be verified, so never match
+            self._literals = [_literals(r[4]) if r[4] is not None else None for r in rows]
+
+    def get(self, key: str) -> str | None:
+        """Exact lookup by hash_key(...)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response_json FROM entries WHERE key = ?", (bytes.fromhex(key),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        """Store an exact-only entry (no embedding, never matched semantically)"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, '', NULL, ?, NULL)", (bytes.fromhex(key), value)
+            )
+            self._db.commit()
+
+    def lookup(self, text: str, context: str = "") -> str | None:
+        """
+        Semantic lookup: the closest stored question under the same context,
+        if it also has exactly the same numbers and months as text
+        """
+        if not self._values:
+            return None
+        try:
+            vec = embed(text)
+        except Exception:
+            # embedding failures only cost a cache miss
+            return None
+        literals = _literals(text)
+        with self._lock:
+            scores = self._matrix @ vec
+            mask = np.fromiter(
+                (c == context and lit == literals for c, lit in zip(self._contexts, self._literals)),
+                dtype=bool, count=len(self._contexts),
+            )
+            scores = np.where(mask, scores, -1.0)
+            best = int(scores.argmax())
+            if scores[best] >= self.threshold:
+                return self._values[best]
+        return None
+
+    def add(self, key: str, text: str, value: str, context: str = "") -> None:
+        """Store an entry reachable both by its exact key and by similarity to text"""
+        try:
+            vec = embed(text)
+        except Exception:
+            self.set(key, value)
+            return
+        raw_key = bytes.fromhex(key)
+        with self._lock:
+            if raw_key in self._keys:
+                i = self._keys.index(raw_key)
+                self._matrix[i] = vec
+                self._contexts[i] = context
+                self._literals[i] = _literals(text)
+                self._values[i] = value
+            else:
+                self._matrix = vec[None, :] if not self._values else np.vstack([self._matrix, vec])
+                self._keys.append(raw_key)
+                self._contexts.append(context)
+                self._literals.append(_literals(text))
+                self._values.append(value)
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (raw_key, context, vec.tobytes(), value, text),
+            )
+            self._db.commit()
+
+
+_PROMPT_CACHES: dict[str, PromptCache] = {}
+_PROMPT_CACHES_LOCK = threading.Lock()
+
+
+def get_prompt_cache(name: str, persist: bool = True) -> PromptCache:
+    """One PromptCache per name (e.g. per table metadata hash), opened once"""
+    with _PROMPT_CACHES_LOCK:
+        if name not in _PROMPT_CACHES:
+            path = CACHE_DIR / f"prompts_{name}.sqlite3" if persist else None
+            _PROMPT_CACHES[name] = PromptCache(path)
+        return _PROMPT_CACHES[name]
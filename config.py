@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+import os
+
+from dotenv import load_dotenv
+
+# .env is read once, here; everything else imports its settings from this module
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Write the upload summary with an LLM instead of the deterministic template
+USE_LLM_FORMATTER = os.getenv("USE_LLM_FORMATTER") == "1"
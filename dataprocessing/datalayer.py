@@ -1,20 +1,28 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import duckdb
 
+from cache import CACHE_DIR
+
 
 # Profile for a single column, should be later consumed by the schema agent
-@dataclass
+@dataclass(slots=True)
 class ColumnProfile:
     name: str
     dtype: str                          # DuckDB native type string
     sample_values: list[Any]            # Up to 5 distinct values
-    distinct_count: int                 # Total number of distinct (non-null) values
+    distinct_count: int                 # Distinct (non-null) values, HyperLogLog estimate
     null_count: int                     # Number of NULL rows
     total_rows: int                     # Total rows in the table
     high_cardinality: bool              # True if distinct_count > CARDINALITY_THRESHOLD
@@ -24,104 +32,203 @@ class ColumnProfile:
 
 
 # Full profile of the table
-@dataclass
+@dataclass(slots=True)
 class TableProfile:
     table_name: str
     file_path: str
     total_rows: int
     total_columns: int
+    numeric_column_count: int           # Columns with a NUMERIC_TYPES dtype
+    content_hash: str                   # file_hash of the csv; stable across loads
     columns: list[ColumnProfile] = field(default_factory=list)
 
 
 EXCEEDS_LIMIT: int = 50       #To be used to flag if >5 distinct values
 MAX_SAMPLE_VALUES: int = 5   #Number of distinct values to fetch to be fed as examples
-NUMERIC_TYPES = {
+SAMPLE_RESERVOIR_ROWS: int = 1000   #Rows reservoir-sampled once to pick the distinct samples from
+# Fixed seed (and ordered samples below) so the same file always yields the
+# same profile, hence byte-identical metadata prompts and stable cache keys
+SAMPLE_SEED: int = 42
+NUMERIC_TYPES = frozenset({
     "TINYINT", "SMALLINT", "INTEGER", "INT", "BIGINT",
     "HUGEINT", "FLOAT", "DOUBLE", "DECIMAL", "REAL",
     "UBIGINT", "UINTEGER", "USMALLINT", "UTINYINT",
+})
+# the same set as a SQL IN-list, for classifying columns inside DuckDB
+_NUMERIC_TYPES_SQL = ", ".join(f"'{t}'" for t in sorted(NUMERIC_TYPES))
+
+# Session connection settings. Insertion order is not preserved: every
+# result that matters is ordered explicitly, and dropping it lets
+# aggregations and the csv load run with less memory. Past memory_limit,
+# large sorts/joins/aggregates spill to temp_directory instead of failing.
+DUCKDB_CONFIG: dict[str, Any] = {
+    "threads": int(os.getenv("DUCKDB_THREADS", os.cpu_count() or 1)),
+    "memory_limit": os.getenv("DUCKDB_MEMORY_LIMIT", "4GB"),
+    "temp_directory": os.getenv("DUCKDB_TEMP_DIR", str(CACHE_DIR / "duckdb_tmp")),
+    "enable_object_cache": True,
+    "preserve_insertion_order": False,
 }
 
 
-def load_and_profile(csv_path: str | Path) -> TableProfile:
-    """This function loads the csv into duckdb and reutrns a full table profile"""
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+# Uploads are converted to Parquet once and stored by content hash, so a
+# re-upload of the same file skips the csv parse entirely
+PARQUET_DIR = CACHE_DIR / "parquet"
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path: str | Path) -> str:
+    """blake2b content hash of a file, read in 1 MiB chunks"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def csv_to_parquet(con: duckdb.DuckDBPyConnection, csv_path: Path, content_hash: str) -> Path:
+    """Parquet copy of the csv (zstd), converted only if not already cached"""
+    parquet_path = PARQUET_DIR / f"{content_hash}.parquet"
+    if parquet_path.exists():
+        return parquet_path
+
+    PARQUET_DIR.mkdir(parents=True, exist_ok=True)
+    # written under a temporary name and renamed, so a concurrent session
+    # never reads a half-written file
+    tmp_path = parquet_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    con.execute(
+        f"""
+        COPY (SELECT * FROM read_csv_auto(?, header=true, ignore_errors=true, sample_size=-1))
+        TO {_literal(str(tmp_path))} (FORMAT PARQUET, COMPRESSION ZSTD)
+        """,
+        [str(csv_path.resolve())],
+    )
+    os.replace(tmp_path, parquet_path)
+    return parquet_path
+
+
+def _sample_values(con: duckdb.DuckDBPyConnection, sample_table: str, col_name: str) -> list[Any]:
+    # Sample distinct values, provide the agent with a sample of 5 rows
+    # to help with some context on what the data actually looks like.
+    # Runs on its own cursor so columns can be sampled from worker threads.
+    cursor = con.cursor()
+    try:
+        sample_rows = cursor.execute(
+            f"""
+            SELECT DISTINCT {_quote(col_name)}
+            FROM {sample_table}
+            WHERE {_quote(col_name)} IS NOT NULL
+            ORDER BY 1
+            LIMIT {MAX_SAMPLE_VALUES}
+            """
+        ).fetchall()
+    finally:
+        cursor.close()
+    return [row[0] for row in sample_rows]
+
+
+def table_name_for(csv_path: str | Path) -> str:
+    """DuckDB table name used for a csv file, always a plain identifier"""
+    name = re.sub(r"\W", "_", Path(csv_path).stem.lower())
+    return name if name[:1].isalpha() else f"t_{name}"
+
+
+def load_and_profile(
+    csv_path: str | Path, content_hash: str | None = None
+) -> tuple[TableProfile, duckdb.DuckDBPyConnection]:
+    """This function loads the csv into duckdb and reutrns a full table profile
+    together with the open connection, which the session keeps querying"""
 
     csv_path = Path(csv_path)
     if not csv_path.exists():
         raise FileNotFoundError(f"CSV file not found at: {csv_path}")
     
-    table_name = csv_path.stem.lower().replace(" ", "_").replace("-", "_")
+    table_name = table_name_for(csv_path)
 
-    con = duckdb.connect(database=":memory:")
+    con = duckdb.connect(database=":memory:", config=DUCKDB_CONFIG)
 
-    # loading the csv file
+    # the csv is parsed once into a Parquet copy; the table is a view over
+    # it, so every query (profiling and the session) reads only the columns
+    # it touches and never holds a second copy of the data in memory
+    content_hash = content_hash or file_hash(csv_path)
+    parquet_path = csv_to_parquet(con, csv_path, content_hash)
     con.execute(
-        f"""
-        CREATE TABLE {table_name} AS
-        SELECT * FROM read_csv_auto('{csv_path.resolve()}', header=true, all_varchar=true)  
-        """
+        f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet({_literal(str(parquet_path))})"
     )
 
-    # Total row count
-    total_rows: int = con.execute(
-        f"SELECT COUNT(*) FROM {table_name}"
-    ).fetchone()[0]
-
-    # schema - column names + types
-    schema_rows = con.execute(
-        f"PRAGMA table_info('{table_name}')"
+    # schema - column names + types, with the numeric classification done in
+    # SQL (DECIMAL(18,3) -> DECIMAL) so Python only reads a flag
+    columns = con.execute(
+        f"""
+        SELECT column_name, data_type, split_part(data_type, '(', 1) IN ({_NUMERIC_TYPES_SQL}) AS is_numeric
+        FROM information_schema.columns
+        WHERE table_name = ?
+        ORDER BY ordinal_position
+        """,
+        [table_name],
     ).fetchall()
 
+    # One fused scan for every per-column statistic instead of 3-4 queries
+    # per column: row count, then per column null count and distinct estimate,
+    # plus min/max/avg for numeric columns.
+    select_list = ["COUNT(*)"]
+    for col_name, _, is_numeric in columns:
+        q = _quote(col_name)
+        select_list.append(f"COUNT(*) FILTER (WHERE {q} IS NULL)")
+        # HyperLogLog estimate: one streaming sketch instead of a hash set
+        # sized to the cardinality; only used for hints / high_cardinality
+        select_list.append(f"approx_count_distinct({q})")
+        if is_numeric:
+            select_list += [f"MIN({q})", f"MAX({q})", f"AVG({q})"]
+    stats = con.execute(
+        f"SELECT {', '.join(select_list)} FROM {table_name}"
+    ).fetchone()
+
+    total_rows: int = stats[0]
+    pos = 1
+
+    # One reservoir sample of the rows, materialised, so the per-column sample
+    # queries below scan a few hundred rows instead of the full table. Not a
+    # TEMP table: those are private to one connection, and the sample queries
+    # run on separate cursors. DuckDB drops the GIL while executing, so the
+    # per-column queries overlap across threads.
+    sample_table = f"{table_name}__sample"
+    con.execute(
+        f"""
+        CREATE TABLE {sample_table} AS
+        SELECT * FROM {table_name} USING SAMPLE reservoir({SAMPLE_RESERVOIR_ROWS} ROWS) REPEATABLE ({SAMPLE_SEED})
+        """
+    )
+    with ThreadPoolExecutor(max_workers=min(len(columns), os.cpu_count() or 1) or 1) as pool:
+        samples = list(pool.map(
+            lambda col: _sample_values(con, sample_table, col[0]), columns
+        ))
 
     column_profiles: list[ColumnProfile] = []
+    numeric_column_count = 0
 
     # This loop process for each column in the table, to enrich the agents
     # further in the pipeline with some sort of metadata
-    for _, col_name, col_type, *_ in schema_rows:
-        col_type_upper = col_type.upper().split("(")[0].strip()
-
-        # null count
-        null_count: int = con.execute(
-            f'SELECT COUNT(*) FROM {table_name} WHERE "{col_name}" IS NULL'
-        ).fetchone()[0]
-
-        # distinct non-null values
-        distinct_count: int = con.execute(
-            f'SELECT COUNT(DISTINCT "{col_name}") FROM {table_name} WHERE "{col_name}" IS NOT NULL'
-        ).fetchone()[0]
+    for (col_name, col_type, is_numeric), sample_values in zip(columns, samples):
+        null_count, distinct_count = stats[pos], stats[pos + 1]
+        pos += 2
 
         high_cardinality = distinct_count > EXCEEDS_LIMIT
 
-        # Sample distinct values, provide the agent with a sample of 5 rows
-        # to help with some context on what the data actually looks like
-        sample_rows = con.execute(
-            f"""
-            SELECT DISTINCT "{col_name}"
-            FROM {table_name}
-            WHERE "{col_name}" IS NOT NULL
-            ORDER BY RANDOM()
-            LIMIT {MAX_SAMPLE_VALUES}
-            """
-        ).fetchall()
-        sample_values = [row[0] for row in sample_rows]
-
         min_val = max_val = avg_val = None
-        if col_type_upper in NUMERIC_TYPES:
-            stats = con.execute(
-                f"""
-                SELECT
-                    MIN("{col_name}"),
-                    MAX("{col_name}"),
-                    AVG("{col_name}")
-                FROM {table_name}
-                WHERE "{col_name}" IS NOT NULL
-                """
-            ).fetchone()
-            if stats:
-                min_val, max_val, avg_val = (
-                    float(stats[0]) if stats[0] is not None else None,
-                    float(stats[1]) if stats[1] is not None else None,
-                    float(stats[2]) if stats[2] is not None else None,
-                )
+        if is_numeric:
+            numeric_column_count += 1
+            min_val, max_val, avg_val = (
+                float(v) if v is not None else None for v in stats[pos:pos + 3]
+            )
+            pos += 3
 
         column_profiles.append(
             ColumnProfile(
@@ -139,15 +246,107 @@ def load_and_profile(csv_path: str | Path) -> TableProfile:
         )
 
 #  if group by in high cardinality necessary always apply limit
-    con.close()
+    con.execute(f"DROP TABLE {sample_table}")
 
-    return TableProfile(
+    profile = TableProfile(
         table_name=table_name,
         file_path=str(csv_path.resolve()),
         total_rows=total_rows,
         total_columns=len(column_profiles),
+        numeric_column_count=numeric_column_count,
+        content_hash=content_hash,
         columns=column_profiles,
     )
+    return profile, con
+
+
+# Bumped whenever a dataset is (re)loaded. Sessions keep the version they
+# loaded and include it in result cache keys, so stale results never leak
+# across uploads.
+DATA_VERSION: int = 0
+_DATA_VERSION_LOCK = threading.Lock()
+
+
+def bump_data_version() -> int:
+    global DATA_VERSION
+    with _DATA_VERSION_LOCK:
+        DATA_VERSION += 1
+        return DATA_VERSION
+
+
+DUCKDB_POOL_SIZE: int = int(os.getenv("DUCKDB_POOL_SIZE", "4"))
+
+
+# A single DuckDB connection runs one query at a time. The pool hands out
+# cursors (independent connections to the same database) so concurrent
+# questions can execute in parallel. A thread-safe queue is used instead of
+# an asyncio.Semaphore because every graph run gets its own event loop.
+# Checkout, query and release all happen inside one worker thread, so a
+# cancelled caller (e.g. the graph timeout) can neither leak a cursor nor
+# return one that is still running its query. The cancelled caller also
+# interrupts that query, so the timeout is not held up by the worker thread.
+POOL_WAIT_POLL_SECONDS = 0.1
+
+
+class _PoolJob:
+    """One DuckDBPool.run call, shared between the caller and its worker thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.cursor: duckdb.DuckDBPyConnection | None = None
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            cursor = self.cursor
+        if cursor is not None:
+            cursor.interrupt()
+
+
+class DuckDBPool:
+    def __init__(self, con: duckdb.DuckDBPyConnection, size: int = DUCKDB_POOL_SIZE):
+        self._cursors = [con.cursor() for _ in range(size)]
+        self._idle: queue.Queue[duckdb.DuckDBPyConnection] = queue.Queue()
+        for cursor in self._cursors:
+            self._idle.put(cursor)
+
+    def _call(self, job: _PoolJob, fn: Callable[..., Any], *args: Any) -> Any:
+        # poll, so a job cancelled while waiting for a free cursor gives up
+        while True:
+            try:
+                cursor = self._idle.get(timeout=POOL_WAIT_POLL_SECONDS)
+                break
+            except queue.Empty:
+                if job.cancelled:
+                    return None
+        with job.lock:
+            if job.cancelled:
+                self._idle.put(cursor)
+                return None
+            job.cursor = cursor
+        try:
+            return fn(cursor, *args)
+        finally:
+            with job.lock:
+                job.cursor = None
+            self._idle.put(cursor)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run fn(cursor, *args) on a pooled cursor in a worker thread"""
+        job = _PoolJob()
+        try:
+            return await asyncio.to_thread(self._call, job, fn, *args)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+
+    def close(self) -> None:
+        for cursor in self._cursors:
+            try:
+                cursor.close()
+            except Exception:
+                pass
 
 
 def print_profile(profile: TableProfile) -> None:
@@ -165,5 +364,5 @@ def print_profile(profile: TableProfile) -> None:
             print(f"    numeric : min={col.min_val:.2f}  max={col.max_val:.2f}  avg={col.avg_val:.2f}")
     print()
 
-# profile = load_and_profile("data\\Amazon Sale Report.csv")
+# profile, _ = load_and_profile("data\\Amazon Sale Report.csv")
 # print_profile(profile)
\ No newline at end of file
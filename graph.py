@@ -1,37 +1,52 @@
 from __future__ import annotations
 
+import asyncio
+from functools import lru_cache
 from typing import Any
 
-from dotenv import load_dotenv
 from langgraph.graph import END, START, StateGraph
 
-load_dotenv()
-
 from state import RetailAgenticState
 from agents.query_resolution_agent import query_resolution_agent
 from agents.data_extraction_agent import data_extraction_agent
-from agents.validation_agent import validation_agent 
+from agents.validation_agent import VALIDATION_BATCH_WINDOW, validation_agent
 from agents.formatter_agent import formatter_agent 
 
 MAX_RETRIES_RESOLUTION = 3
 MAX_RETRIES_EXTRACTION = 3
 
+# Upper bound for one question, including every validation/retry cycle
+GRAPH_TIMEOUT_SECONDS = 300
+
+# Questions of one batch running through the graph at the same time
+BATCH_MAX_CONCURRENCY = 4
+# How long a batched question's validation waits to share one LLM call
+BATCH_VALIDATION_WINDOW_SECONDS = 0.05
+
+# failure_stage -> (node to re-run, retry counter, retry budget).
+# Only the failing stage is re-run: a bad spec goes back to resolution,
+# bad or failing SQL goes straight to extraction with the same spec
+_RETRY_ROUTES = {
+    "resolution": ("query_resolution", "resolution_retry_count", MAX_RETRIES_RESOLUTION),
+    "sql":        ("data_extraction", "extraction_retry_count", MAX_RETRIES_EXTRACTION),
+    "execution":  ("data_extraction", "extraction_retry_count", MAX_RETRIES_EXTRACTION),
+}
+
+
 def validation_router(state: RetailAgenticState) -> str:
     if state.get("validation_passed"):
         return "formatter"
-    
-    route = state.get("route_to", "data_extraction")
-    res_used = state.get("resolution_retry_count", 0)
-    ext_used = state.get("extraction_retry_count", 0)
 
-    if route == "query_resolution" and res_used < MAX_RETRIES_RESOLUTION:
-        return "query_resolution"
-    if route == "data_extraction" and ext_used < MAX_RETRIES_EXTRACTION:
-        return "data_extraction"
-    
-    return "formatter"
+    route = _RETRY_ROUTES.get(state.get("failure_stage") or "sql")
+    if route is None:
+        return "formatter"
+    node, counter, budget = route
+    return node if state.get(counter, 0) < budget else "formatter"
 
 
+# The compiled graph holds no per-question or per-dataset state, so one
+# instance per process is shared by every Session, request and upload
+@lru_cache(maxsize=1)
 def build_graph() -> Any:
     graph = StateGraph(RetailAgenticState)
 
@@ -54,4 +69,39 @@ def build_graph() -> Any:
     )
     graph.add_edge("formatter", END)
 
-    return graph.compile()
\ No newline at end of file
+    return graph.compile()
+
+
+def run_graph(graph: Any, state: RetailAgenticState) -> RetailAgenticState:
+    """
+    Run the compiled graph from synchronous code (CLI / Streamlit).
+    The agent nodes are async, so the graph is driven through ainvoke.
+    """
+    return asyncio.run(
+        asyncio.wait_for(graph.ainvoke(state), timeout=GRAPH_TIMEOUT_SECONDS)
+    )
+
+
+def run_graph_batch(
+    graph: Any, states: list[RetailAgenticState]
+) -> list[RetailAgenticState | BaseException]:
+    """
+    Run several independent questions through the graph concurrently
+    (at most BATCH_MAX_CONCURRENCY at a time); their validations are sent to
+    the LLM together where they coincide. Every question gets its own
+    GRAPH_TIMEOUT_SECONDS, counted from when it starts, and a failing or
+    timed-out question is returned as its exception without cancelling the
+    others. Results are in input order.
+    """
+    async def _run_all() -> list[RetailAgenticState | BaseException]:
+        slots = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+        # validations reached within the window go to the LLM in one call
+        VALIDATION_BATCH_WINDOW.set(BATCH_VALIDATION_WINDOW_SECONDS)
+
+        async def _run_one(state: RetailAgenticState) -> RetailAgenticState:
+            async with slots:
+                return await asyncio.wait_for(graph.ainvoke(state), timeout=GRAPH_TIMEOUT_SECONDS)
+
+        return await asyncio.gather(*(_run_one(s) for s in states), return_exceptions=True)
+
+    return asyncio.run(_run_all())
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from collections import Counter
+from functools import lru_cache
+
+from langchain_openai import ChatOpenAI
+
+from config import OPENAI_API_KEY
+
+
+# Clients are built once per (model, temperature) and shared by every agent,
+# so the httpx connection pool and the pydantic schema conversion are reused
+# instead of being recreated on each call.
+#
+# Prompt layout: every agent sends its static system prompt first, then the
+# per-table metadata block, and everything that changes per call (question,
+# history, spec, feedback) last. The leading messages are then byte-identical
+# across calls, and OpenAI's automatic prompt cache reuses any shared prefix
+# of >= 1024 tokens; dynamic content placed in front would break it.
+#
+# cache_key is sent as OpenAI's prompt_cache_key: requests with the same key
+# (same agent + table, i.e. the same system prompt and metadata prefix) are
+# routed together, which keeps the automatic prefix cache hitting.
+@lru_cache(maxsize=32)
+def get_llm(
+    model: str, temperature: float = 0, streaming: bool = False, cache_key: str | None = None
+) -> ChatOpenAI:
+    return ChatOpenAI(
+        model=model,
+        api_key=OPENAI_API_KEY,
+        temperature=temperature,
+        streaming=streaming,
+        model_kwargs={"prompt_cache_key": cache_key} if cache_key else {},
+    )
+
+
+# json_schema + strict sends the schema as response_format instead of a tool
+# definition, so the model is constrained to it and no tool-call parsing runs.
+@lru_cache(maxsize=32)
+def structured_llm(model: str, schema: type, temperature: float = 0, cache_key: str | None = None):
+    return get_llm(model, temperature, cache_key=cache_key).with_structured_output(
+        schema, method="json_schema", strict=True
+    )
+
+
+# Two-tier cascade: the small model handles first attempts, the larger one
+# is used for retries (validation feedback) or when the small model's
+# structured output cannot be parsed.
+FAST_MODEL = "gpt-4o-mini"
+STRONG_MODEL = "gpt-5-mini"
+
+# "<schema>:<model>" -> number of answers it produced, to tune the cascade
+MODEL_USAGE: Counter[str] = Counter()
+
+
+async def cascade(schema: type, messages: list[dict], escalate: bool = False, cache_key: str | None = None):
+    if not escalate:
+        try:
+            result = await structured_llm(FAST_MODEL, schema, cache_key=cache_key).ainvoke(messages)
+            MODEL_USAGE[f"{schema.__name__}:{FAST_MODEL}"] += 1
+            return result
+        except Exception:
+            MODEL_USAGE[f"{schema.__name__}:{FAST_MODEL}:failed"] += 1
+    result = await structured_llm(STRONG_MODEL, schema, cache_key=cache_key).ainvoke(messages)
+    MODEL_USAGE[f"{schema.__name__}:{STRONG_MODEL}"] += 1
+    return result
@@ -3,17 +3,65 @@ from __future__ import annotations
 import argparse
 import os
 import sys
+import threading
 from pathlib import Path
 
-from dotenv import load_dotenv
-load_dotenv()
+import config  # noqa: F401  (loads .env)
 
-from dataprocessing.datalayer import load_and_profile
-from agents.query_resolution_agent import build_metadata_context, trim_history
-from graph import build_graph
+from agents.query_resolution_agent import new_history
+from llm import MODEL_USAGE
+from session import Session
 from state import RetailAgenticState
 
 
+QUESTION_SEPARATOR = ";"
+
+
+def _report(final_state: RetailAgenticState) -> dict:
+    """Print one answered question and return its assistant history turn"""
+    sql = final_state.get("sql", "")
+    print(f"SQL: {sql}")
+
+    resolution_retry = final_state.get("resolution_retry_count")
+    print(f"Resolution retries: {resolution_retry}")
+
+    extraction_retry = final_state.get("extraction_retry_count")
+    print(f"Extraction retries: {extraction_retry}")
+
+    answer = final_state.get("final_answer") or "No answer was produced."
+
+    resolution = final_state.get("resolution")
+    query_spec_dict = resolution.model_dump() if resolution else None
+
+    print(f"\nAssistant:\n{answer}")
+
+    if os.getenv("DEBUG") and sql:
+        print("\n[SQL]")
+        print(sql)
+
+    return {
+        "role": "assistant",
+        "content": answer,
+        "query_spec": query_spec_dict,
+    }
+
+
+def _report_failure(exc: BaseException) -> dict:
+    """Print a failed question and return its assistant history turn"""
+    answer = f"Something went wrong: {str(exc) or type(exc).__name__}"
+    print(f"\nAssistant:\n{answer}")
+    return {"role": "assistant", "content": answer, "query_spec": None}
+
+
+def _report_usage() -> None:
+    """Print how many answers each model produced, to tune the cascade"""
+    if not MODEL_USAGE:
+        return
+    print("\nModel usage:")
+    for name, count in sorted(MODEL_USAGE.items()):
+        print(f"  {name}: {count}")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Retail Insights Assistant")
     parser.add_argument("--csv", default="data/Amazon Sale Report.csv")
@@ -24,26 +72,17 @@ def main() -> None:
         print(f"\nFile not found: {csv_path}")
         sys.exit(1)
 
-    # Load dataset
+    # Load dataset and compile the graph once for the whole loop
     print(f"\nLoading {csv_path.name} ...", flush=True)
-    table_profile = load_and_profile(csv_path)
+    session = Session.load(csv_path)
+    table_profile = session.profile
     print(f"Loaded {table_profile.total_rows:,} rows and {table_profile.total_columns} columns")
-
-    metadata_str = build_metadata_context(table_profile)
-
-    # Create DuckDB connection
-    import duckdb
-    db_con = duckdb.connect(database=":memory:")
-    db_con.execute(
-        f"CREATE TABLE {table_profile.table_name} AS "
-        f"SELECT * FROM read_csv_auto('{csv_path.resolve()}', header=true, ignore_errors=true, sample_size=-1)"
-    )
-
-    print("Building graph...")
-    graph = build_graph()
     print("Ready.\n")
 
-    chat_history: list[dict] = []
+    # Warm-up runs while the first question is being typed
+    threading.Thread(target=session.warm, daemon=True).start()
+
+    chat_history = new_history()
 
     print("Retail Insights Assistant (type 'exit' to quit)\n")
 
@@ -60,72 +99,36 @@ def main() -> None:
             print("\nExiting.")
             break
 
-        chat_history.append({"role": "user", "content": user_input})
-
-        initial_state: RetailAgenticState = {
-            "table_metadata": metadata_str,
-            "db_con": db_con,
-            "table_name": table_profile.table_name,
-            "user_query": user_input,
-            "chat_history": list(chat_history),
-
-            "resolution": None,
-            "sql": "",
-            "rows": [],
-            "columns": [],
-
-            "validation_passed": False,
-            "validation_reason": "",
-            "validation_feedback": "",
-            "route_to": "",
-            "resolution_retry_count": 0,
-            "extraction_retry_count": 0,
-
-            "final_answer": "",
-            "messages": [],
-            "error": None,
-        }
+        # Several questions on one line ("top categories; sales by state")
+        # are answered together as independent questions
+        questions = [q.strip() for q in user_input.split(QUESTION_SEPARATOR) if q.strip()]
 
         print("Thinking...", flush=True)
 
         try:
-            final_state: RetailAgenticState = graph.invoke(initial_state)
+            if len(questions) > 1:
+                final_states = session.run_many(questions, chat_history)
+            else:
+                chat_history.append({"role": "user", "content": user_input})
+                final_states = [session.run(user_input, chat_history)]
         except Exception as exc:
-            answer = f"Something went wrong: {exc}"
-            print(f"\nAssistant:\n{answer}")
-            chat_history.append({"role": "assistant", "content": answer, "query_spec": None})
-            chat_history = trim_history(chat_history)
+            if len(questions) > 1:
+                chat_history.append({"role": "user", "content": user_input})
+            chat_history.append(_report_failure(exc))
             continue
 
-        sql = final_state.get("sql", "")
-        print(f"SQL: {sql}")
-
-        resolution_retry = final_state.get("resolution_retry_count")
-        print(f"Resolution retries: {resolution_retry}")
-
-        extraction_retry = final_state.get("extraction_retry_count")
-        print(f"Extraction retries: {extraction_retry}")
-
-        answer = final_state.get("final_answer") or "No answer was produced."
-
-        resolution = final_state.get("resolution")
-        query_spec_dict = resolution.model_dump() if resolution else None
-
-        chat_history.append({
-            "role": "assistant",
-            "content": answer,
-            "query_spec": query_spec_dict,
-        })
-
-        chat_history = trim_history(chat_history)
-
-        print(f"\nAssistant:\n{answer}")
-
-        if os.getenv("DEBUG") and sql:
-            print("\n[SQL]")
-            print(sql)
-
-    db_con.close()
+        for question, final_state in zip(questions, final_states):
+            if len(questions) > 1:
+                print(f"\n> {question}")
+                chat_history.append({"role": "user", "content": question})
+            if isinstance(final_state, BaseException):
+                # this question failed or timed out; the others still answered
+                chat_history.append(_report_failure(final_state))
+            else:
+                chat_history.append(_report(final_state))
+
+    _report_usage()
+    session.close()
 
 
 if __name__ == "__main__":
@@ -90,3 +90,9 @@ class ValidationOutput(BaseModel):
             "When passed=True set this to ''."
         )
     )
+
+
+class BatchValidationOutput(BaseModel):
+    results: list[ValidationOutput] = Field(
+        description="One validation result per numbered item, in item order."
+    )
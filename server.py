@@ -0,0 +1,89 @@
+"""
+Retail Insights — HTTP API
+==========================
+Keeps one warm Session (loaded table + compiled graph) in the process, so
+every request reuses it instead of re-loading the csv.
+Run with:  RETAIL_CSV="data/Amazon Sale Report.csv" uvicorn server:app
+"""
+
+from __future__ import annotations
+
+import os
+from contextlib import asynccontextmanager
+from typing import Any, Literal
+
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel, Field
+
+import config  # noqa: F401  (loads .env)
+from agents.query_resolution_agent import new_history
+from llm import MODEL_USAGE
+from session import Session
+
+CSV_PATH = os.getenv("RETAIL_CSV", "data/Amazon Sale Report.csv")
+
+
+class ChatTurn(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str
+    # the resolved spec of an assistant turn, used to patch follow-ups
+    query_spec: dict[str, Any] | None = None
+
+
+class ChatRequest(BaseModel):
+    query: str
+    # previous turns, oldest first
+    history: list[ChatTurn] = Field(default_factory=list)
+
+
+class ChatResponse(BaseModel):
+    answer: str
+    sql: str
+    query_spec: dict[str, Any] | None
+    error: str | None = None
+
+
+SESSION: Session | None = None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global SESSION
+    SESSION = Session.load(CSV_PATH)
+    SESSION.warm()
+    yield
+    SESSION.close()
+
+
+app = FastAPI(title="Retail Insights", lifespan=lifespan)
+
+
+# Plain def: FastAPI runs it on a worker thread, where run_graph can start
+# its own event loop. The DuckDB pool lets concurrent requests query in
+# parallel.
+@app.post("/chat")
+def chat(request: ChatRequest) -> ChatResponse:
+    if SESSION is None:
+        raise HTTPException(status_code=503, detail="dataset not loaded")
+
+    chat_history = new_history()
+    chat_history.extend(turn.model_dump() for turn in request.history)
+    chat_history.append({"role": "user", "content": request.query})
+
+    try:
+        final_state = SESSION.run(request.query, chat_history)
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail="the question timed out") from None
+    resolution = final_state.get("resolution")
+    return ChatResponse(
+        answer=final_state.get("final_answer") or "No answer was produced.",
+        sql=final_state.get("sql", ""),
+        query_spec=resolution.model_dump() if resolution else None,
+        error=final_state.get("error"),
+    )
+
+
+# "<schema>:<model>" -> answers produced since start-up, to tune the cascade
+@app.get("/usage")
+def usage() -> dict[str, int]:
+    return dict(MODEL_USAGE)
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+
+import duckdb
+
+from dataprocessing.datalayer import DuckDBPool, TableProfile, bump_data_version, load_and_profile
+from agents.data_extraction_agent import table_system_prompt
+from agents.query_resolution_agent import build_metadata_context, count_tokens, metadata_system_prompt
+from graph import build_graph, run_graph, run_graph_batch
+from state import RetailAgenticState
+
+
+# Everything that is expensive to build for one dataset: the loaded table,
+# its metadata block and the compiled graph. Built once and reused for every
+# question, by the CLI loop and by the HTTP server.
+@dataclass
+class Session:
+    profile: TableProfile
+    db_con: duckdb.DuckDBPyConnection
+    db_pool: DuckDBPool
+    metadata_str: str
+    data_version: int
+    graph: Any
+
+    @classmethod
+    def load(cls, csv_path: str | Path) -> Session:
+        profile, db_con = load_and_profile(csv_path)
+        return cls(
+            profile=profile,
+            db_con=db_con,
+            db_pool=DuckDBPool(db_con),
+            metadata_str=build_metadata_context(profile),
+            data_version=bump_data_version(),
+            graph=build_graph(),
+        )
+
+    def warm(self) -> None:
+        """
+        First-question set-up done ahead of time (e.g. while the user types):
+        render the cached prompt prefixes, load the tokenizer and read the
+        table's Parquet metadata into DuckDB's object cache
+        """
+        metadata_system_prompt(self.metadata_str)
+        table_system_prompt(self.profile.table_name, self.metadata_str)
+        count_tokens("")
+        with self.db_con.cursor() as cur:
+            cur.execute(f"SELECT count(*) FROM {self.profile.table_name}").fetchall()
+
+    def initial_state(self, user_query: str, chat_history: Sequence[dict]) -> RetailAgenticState:
+        return {
+            "table_metadata": self.metadata_str,
+            "db_con": self.db_con,
+            "db_pool": self.db_pool,
+            "data_version": self.data_version,
+            "content_hash": self.profile.content_hash,
+            "table_name": self.profile.table_name,
+            "user_query": user_query,
+            "chat_history": chat_history,
+
+            "resolution": None,
+            "resolution_cache_key": "",
+            "extraction_cache_key": "",
+            "sql": "",
+            "result": None,
+            "row_count": 0,
+
+            "validation_passed": False,
+            "validation_reason": "",
+            "validation_feedback": "",
+            "route_to": "",
+            "failure_stage": "",
+            "resolution_retry_count": 0,
+            "extraction_retry_count": 0,
+
+            "final_answer": "",
+            "messages": [],
+            "error": None,
+        }
+
+    def run(self, user_query: str, chat_history: Sequence[dict]) -> RetailAgenticState:
+        """Answer one question; chat_history already ends with this question"""
+        return run_graph(self.graph, self.initial_state(user_query, chat_history))
+
+    def run_many(
+        self, user_queries: Sequence[str], chat_history: Sequence[dict]
+    ) -> list[RetailAgenticState | BaseException]:
+        """
+        Answer several questions asked together. They are independent: each
+        one sees chat_history (the turns before the batch) plus itself only.
+        A question that fails or times out is returned as its exception.
+        """
+        return run_graph_batch(self.graph, [
+            self.initial_state(q, [*chat_history, {"role": "user", "content": q}])
+            for q in user_queries
+        ])
+
+    def close(self) -> None:
+        self.db_pool.close()
+        self.db_con.close()
@@ -1,5 +1,6 @@
+import operator
 from typing_extensions import TypedDict
-from typing import Any
+from typing import Annotated, Any, Literal, Sequence
 from models import QueryResolutionOutput
 
 
@@ -7,23 +8,34 @@ class RetailAgenticState(TypedDict):
     user_query: str
     table_metadata: str
     resolution: QueryResolutionOutput | None
-    messages: list[Any]
+    # Nodes return only the keys they change; new messages are appended
+    messages: Annotated[list[Any], operator.add]
     error: str | None
 
     db_con: Any
+    db_pool: Any              # DuckDBPool of cursors on db_con
+    data_version: int         # datalayer.DATA_VERSION of the loaded table
+    content_hash: str         # TableProfile.content_hash; keys the persistent caches
+
+    # cache keys of the spec / SQL produced in this run ("" when nothing new);
+    # the entries are only written once validation passes
+    resolution_cache_key: str
+    extraction_cache_key: str
 
     sql: str
-    rows: list[dict]
-    columns: list[str]
+    result: Any               # query result as a pyarrow.Table, first RESULT_MAX_ROWS rows
+    row_count: int            # total rows the query returned
 
     table_name: str
 
-    chat_history: list[dict] 
+    chat_history: Sequence[dict]   # bounded deque, shared with the caller
 
     validation_passed: bool
     validation_reason: str
     validation_feedback: str   
     route_to: str   
+    # where the last validation failure came from; drives the retry route
+    failure_stage: Literal["resolution", "sql", "execution", ""]
     resolution_retry_count: int   
     extraction_retry_count: int
 